@@ -1,6 +1,7 @@
 """
 API interaction utilities for LLM services
 """
-from src.api.api_request_utils import get_response
+from src.api.api_request_utils import get_response, get_client, get_async_client
+from src.api.concurrency import get_concurrency_controller
 
-__all__ = ['get_response'] 
\ No newline at end of file
+__all__ = ['get_response', 'get_client', 'get_async_client', 'get_concurrency_controller'] 
\ No newline at end of file
@@ -1,7 +1,13 @@
 import os
 import json
-from openai import OpenAI
+import asyncio
+import importlib
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient, Timeout
 from src.utils.env_utils import load_env_variables
+from src.api.rate_limiter import get_rate_limiter
 
 # Load environment variables from the correct location
 load_env_variables()
@@ -11,6 +17,180 @@ API_HOST = os.environ.get('API_HOST', 'api.openai.com')
 USER_AGENT = os.environ.get('USER_AGENT', '')
 CONTENT_TYPE = os.environ.get('CONTENT_TYPE', 'application/json')
 
+# Connection pool and timeouts of the cached clients, in seconds
+API_TIMEOUT = float(os.environ.get('API_TIMEOUT', '600'))
+API_CONNECT_TIMEOUT = float(os.environ.get('API_CONNECT_TIMEOUT', '10'))
+API_MAX_CONNECTIONS = int(os.environ.get('API_MAX_CONNECTIONS', '100'))
+API_MAX_KEEPALIVE = int(os.environ.get('API_MAX_KEEPALIVE', '20'))
+API_KEEPALIVE_EXPIRY = float(os.environ.get('API_KEEPALIVE_EXPIRY', '30'))
+
+# Clients by (api_key, base_url, headers). Sync clients are shared by all threads;
+# async clients are kept per event loop because their connections belong to one loop
+_clients = {}
+_async_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_default_headers():
+    if USER_AGENT:
+        return {"Content-Type": CONTENT_TYPE, "User-Agent": USER_AGENT}
+    return {"Content-Type": CONTENT_TYPE}
+
+
+def get_client_config(api_key, base_url=None, headers=None):
+    # Fill in the defaults and build the cache key of a client
+    if not api_key:
+        raise ValueError("API key is empty or not provided")
+    if base_url is None:
+        base_url = f"https://{API_HOST}/v1"
+    if headers is None:
+        headers = get_default_headers()
+    key = (api_key, base_url, tuple(sorted(headers.items())))
+    return key, base_url, headers
+
+
+def get_http_settings():
+    # Limits comes from the HTTP package the SDK clients are built on (httpx or httpx2),
+    # so the settings match the transport DefaultHttpxClient passes them to
+    transport = importlib.import_module(DefaultHttpxClient.__mro__[1].__module__.partition('.')[0])
+    return {
+        "limits": transport.Limits(
+            max_connections=API_MAX_CONNECTIONS,
+            max_keepalive_connections=API_MAX_KEEPALIVE,
+            keepalive_expiry=API_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": Timeout(API_TIMEOUT, connect=API_CONNECT_TIMEOUT),
+    }
+
+
+def get_client(api_key, base_url=None, headers=None):
+    """
+    Get the cached OpenAI client of an API key, creating it on first use.
+
+    The client keeps a pool of keep-alive connections, so consecutive requests
+    reuse connections instead of opening a new one (and a TLS handshake) each time.
+    It is safe to share between threads.
+
+    Args:
+        api_key (str): The API key for authentication
+        base_url (str): API base url, https://API_HOST/v1 by default
+        headers (dict): Default request headers, Content-Type and User-Agent from the environment by default
+
+    Returns:
+        OpenAI: The shared client
+    """
+    key, base_url, headers = get_client_config(api_key, base_url, headers)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                http_settings = get_http_settings()
+                client = OpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    default_headers=headers,
+                    timeout=http_settings["timeout"],
+                    http_client=DefaultHttpxClient(**http_settings),
+                )
+                _clients[key] = client
+    return client
+
+
+def get_async_client(api_key, base_url=None, headers=None):
+    """
+    Get the cached AsyncOpenAI client of an API key for the running event loop.
+
+    Tasks of the same loop share one client and its connection pool. Each loop
+    gets its own client, which is dropped once the loop is closed. The client
+    does not retry by itself: the request engine retries, and needs to see
+    HTTP 429 responses to adapt its concurrency.
+
+    Returns:
+        AsyncOpenAI: The shared client of the running loop
+    """
+    key, base_url, headers = get_client_config(api_key, base_url, headers)
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        for closed_loop in [l for l in _async_clients if l.is_closed()]:
+            del _async_clients[closed_loop]
+        loop_clients = _async_clients.setdefault(loop, {})
+        client = loop_clients.get(key)
+        if client is None:
+            http_settings = get_http_settings()
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                default_headers=headers,
+                timeout=http_settings["timeout"],
+                max_retries=0,
+                http_client=DefaultAsyncHttpxClient(**http_settings),
+            )
+            loop_clients[key] = client
+    return client
+
+
+def close_clients():
+    # Close the connection pools of the cached sync clients
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+async def close_async_clients():
+    # Close the connection pools of the cached async clients of the running loop
+    with _clients_lock:
+        loop_clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in loop_clients.values():
+        await client.close()
+
+
+def get_response_dict(response):
+    # Response content and token usage as a plain dictionary
+    usage = None
+    if response.usage is not None:
+        usage = {
+            "prompt_tokens": response.usage.prompt_tokens,
+            "completion_tokens": response.usage.completion_tokens,
+            "total_tokens": response.usage.total_tokens,
+        }
+    return {
+        "choices": [
+            {
+                "message": {
+                    "content": response.choices[0].message.content
+                }
+            }
+        ],
+        "usage": usage,
+    }
+
+
+def get_retry_after(error):
+    """
+    Seconds to wait before retrying, as asked by the Retry-After headers of a failed request.
+
+    Returns:
+        float: The delay, or None if the error carries no Retry-After header
+    """
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return max(0.0, float(headers['retry-after-ms']) / 1000)
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            # HTTP date form of the header
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
 
 def get_response(api_key, model, content):
     """
@@ -22,39 +202,61 @@ def get_response(api_key, model, content):
         content (str): The content to send to the model
         
     Returns:
-        dict: The response from the API
+        dict: The response from the API, with its token usage under "usage"
     """
-    # Check if API key is empty or None
-    if not api_key:
-        raise ValueError("API key is empty or not provided")
-    
-    # Create OpenAI client with the provided API key and custom configuration
-    client = OpenAI(
-        api_key=api_key,
-        base_url=f"https://{API_HOST}/v1",
-        default_headers={
-            "Content-Type": CONTENT_TYPE,
-            "User-Agent": USER_AGENT
-        } if USER_AGENT else {"Content-Type": CONTENT_TYPE}
-    )
+    # Reuse the pooled client of this API key, within the rate limits of this model and key
+    client = get_client(api_key)
+    limiter = get_rate_limiter(model, api_key)
+    estimated_tokens = limiter.acquire(content)
     
     # Send request using the official SDK
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "user", "content": content}
-        ]
-    )
+    try:
+        response = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "user", "content": content}
+            ]
+        )
+    except Exception:
+        limiter.record_usage(content, estimated_tokens)
+        raise
     
     # Convert response to dictionary format for backward compatibility
-    response_dict = {
-        "choices": [
-            {
-                "message": {
-                    "content": response.choices[0].message.content
-                }
-            }
-        ]
-    }
+    response_dict = get_response_dict(response)
+    limiter.record_usage(content, estimated_tokens, response_dict['usage'])
     
     return response_dict
+
+
+async def get_response_async(api_key, model, content, on_send=None):
+    """
+    Async version of get_response, sent through the pooled client of the running event loop
+
+    Args:
+        on_send (callable): Called without arguments once the rate limiter lets the
+            request go, so callers can time the API call without the local wait
+
+    Returns:
+        dict: The response from the API, in the same format as get_response
+    """
+    client = get_async_client(api_key)
+    limiter = get_rate_limiter(model, api_key)
+    estimated_tokens = await limiter.acquire_async(content)
+    if on_send is not None:
+        on_send()
+
+    try:
+        response = await client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "user", "content": content}
+            ]
+        )
+    except Exception:
+        limiter.record_usage(content, estimated_tokens)
+        raise
+
+    response_dict = get_response_dict(response)
+    limiter.record_usage(content, estimated_tokens, response_dict['usage'])
+
+    return response_dict
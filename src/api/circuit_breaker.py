@@ -0,0 +1,77 @@
+"""
+Circuit breaker pausing LLM API requests during provider outages
+"""
+
+
+class CircuitBreaker:
+    """
+    Pause new requests after a streak of failures instead of giving up on the run.
+
+    After failure_threshold failed attempts in a row the circuit opens and no
+    request is started for `cooldown` seconds. Then one probe request is let
+    through: if it succeeds the circuit closes, otherwise it opens again with
+    the cooldown doubled (up to max_cooldown). After max_trips openings without
+    any success in between, `aborted` is set.
+
+    Times are time.monotonic() values passed in by the caller.
+
+    Args:
+        failure_threshold (int): Failed attempts in a row that open the circuit
+        cooldown (float): Seconds of the first pause
+        max_cooldown (float): Longest pause in seconds
+        max_trips (int): Openings in a row before giving up
+    """
+
+    def __init__(self, failure_threshold=10, cooldown=30, max_cooldown=300, max_trips=10):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_trips = max_trips
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self.cooldown = cooldown
+        self.open_until = 0.0
+        self.aborted = False
+
+    def allow(self, now):
+        """
+        Returns:
+            str: None if no request may start now, otherwise "probe" for the probe
+                request of a half-open circuit and "closed" for a normal request
+        """
+        if self.state == "closed":
+            return "closed"
+        if self.state == "open" and now >= self.open_until:
+            self.state = "half_open"
+            return "probe"
+        return None
+
+    def cancel_probe(self):
+        # The probe slot was granted but no request was sent, keep waiting for one
+        if self.state == "half_open":
+            self.state = "open"
+
+    def wait_time(self, now):
+        # Seconds until an open circuit lets its probe through
+        if self.state == "open":
+            return max(0.0, self.open_until - now)
+        return 0.0
+
+    def on_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self.cooldown = self.base_cooldown
+
+    def on_failure(self, now, probe=False):
+        self.failures += 1
+        if probe or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.trips += 1
+            if self.trips > self.max_trips:
+                self.aborted = True
+            if probe:
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            self.state = "open"
+            self.open_until = now + self.cooldown
+            print(f"Circuit open for {self.cooldown:g}s after {self.failures} failed requests in a row", flush=True)
@@ -0,0 +1,136 @@
+"""
+Adaptive (AIMD) concurrency window of LLM API calls, per model and API key
+"""
+import os
+import time
+import threading
+from collections import deque
+from openai import RateLimitError, APITimeoutError
+from src.utils.env_utils import load_env_variables
+from src.core.settings import DEFAULT_MAX_IN_FLIGHT
+
+load_env_variables()
+
+# Window a controller starts from, never above its max_window
+API_INITIAL_WINDOW = int(os.environ.get('API_INITIAL_WINDOW', '4'))
+
+# Window added per window-worth of healthy responses, and factor applied on congestion
+ADDITIVE_INCREASE = 1.0
+MULTIPLICATIVE_DECREASE = 0.5
+# A response is healthy when its latency stays within this factor of the average latency
+LATENCY_TOLERANCE = 2.0
+# The window only grows while the recent error rate is below this value
+ERROR_RATE_LIMIT = 0.1
+# Weight of the latest response in the latency and error rate averages
+EMA_WEIGHT = 0.1
+# Entries kept in the window history
+HISTORY_SIZE = 1000
+
+
+def is_congestion_error(e):
+    # HTTP 429 and timeouts mean the provider is overloaded, other errors are counted as failures only
+    if isinstance(e, (RateLimitError, APITimeoutError, TimeoutError)):
+        return True
+    return getattr(e, 'status_code', None) == 429
+
+
+class ConcurrencyController:
+    """
+    Additive-increase / multiplicative-decrease window of concurrent requests.
+
+    The window grows by ADDITIVE_INCREASE for every window-worth of successful
+    responses while their latency and the error rate stay healthy, and is cut by
+    MULTIPLICATIVE_DECREASE on HTTP 429 or a timeout. Requests started before the
+    last cut do not cut it again, so one burst of throttled requests counts once.
+
+    `window` is the current window, `limit` the number of requests it allows in
+    flight, and `history` the (time, window, event) entries of its changes.
+
+    Args:
+        max_window (int): Upper bound of the window
+        min_window (int): Lower bound of the window
+        initial_window (int): Starting window, API_INITIAL_WINDOW by default
+    """
+
+    def __init__(self, max_window, min_window=1, initial_window=None):
+        self.lock = threading.Lock()
+        self.max_window = max(1, int(max_window))
+        self.min_window = max(1, min(int(min_window), self.max_window))
+        if initial_window is None:
+            initial_window = API_INITIAL_WINDOW
+        self.window = float(min(max(initial_window, self.min_window), self.max_window))
+        self.avg_latency = None
+        self.error_rate = 0.0
+        self.last_cut = 0.0
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self.history.append((time.time(), self.window, "start"))
+
+    @property
+    def limit(self):
+        return int(self.window)
+
+    def set_max_window(self, max_window):
+        with self.lock:
+            self.max_window = max(1, int(max_window))
+            self.min_window = min(self.min_window, self.max_window)
+            if self.window > self.max_window:
+                self.set_window(self.max_window, "max_window")
+
+    def set_window(self, window, event):
+        # Called with the lock held, the history only records changes of the integer limit
+        old_limit = self.limit
+        self.window = float(min(max(window, self.min_window), self.max_window))
+        if self.limit != old_limit or event != "increase":
+            self.history.append((time.time(), self.window, event))
+
+    def on_success(self, started, latency):
+        """
+        Record a successful request.
+
+        Args:
+            started (float): time.monotonic() when the request was sent
+            latency (float): Seconds the request took
+        """
+        with self.lock:
+            self.error_rate *= 1 - EMA_WEIGHT
+            healthy = self.avg_latency is None or latency <= LATENCY_TOLERANCE * self.avg_latency
+            self.avg_latency = latency if self.avg_latency is None else self.avg_latency + EMA_WEIGHT * (latency - self.avg_latency)
+            if healthy and self.error_rate < ERROR_RATE_LIMIT and self.window < self.max_window:
+                self.set_window(self.window + ADDITIVE_INCREASE / self.window, "increase")
+
+    def on_error(self, started, error):
+        """
+        Record a failed request, cutting the window if the provider is congested.
+
+        Args:
+            started (float): time.monotonic() when the request was sent
+            error (Exception): The exception raised by the request
+        """
+        with self.lock:
+            self.error_rate += EMA_WEIGHT * (1 - self.error_rate)
+            if is_congestion_error(error) and started >= self.last_cut:
+                self.last_cut = time.monotonic()
+                self.set_window(self.window * MULTIPLICATIVE_DECREASE, "throttled")
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def get_concurrency_controller(model, api_key, max_window=None):
+    """
+    Get the shared concurrency controller of a model and API key.
+
+    The window learned by a controller carries over to later runs of the same
+    model and key. A max_window given here replaces the current one.
+    """
+    key = (model, api_key)
+    with _controllers_lock:
+        controller = _controllers.get(key)
+        if controller is None:
+            controller = ConcurrencyController(max_window if max_window is not None else DEFAULT_MAX_IN_FLIGHT)
+            _controllers[key] = controller
+            return controller
+    if max_window is not None:
+        controller.set_max_window(max_window)
+    return controller
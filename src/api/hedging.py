@@ -0,0 +1,55 @@
+"""
+Hedged requests: a duplicate of a slow request is sent and the first response wins
+"""
+import os
+from collections import deque
+import numpy as np
+from src.utils.env_utils import load_env_variables
+
+load_env_variables()
+
+# Largest share of requests that may be hedged in a run
+API_MAX_HEDGE_RATE = float(os.environ.get('API_MAX_HEDGE_RATE', '0.05'))
+
+# Latencies kept for the percentile, and the least needed before hedging
+LATENCY_HISTORY = 200
+MIN_LATENCY_SAMPLES = 20
+
+
+class HedgePolicy:
+    """
+    When to send a duplicate of a request that has not completed yet.
+
+    A request is hedged once it has been running longer than the given
+    percentile of recently observed latencies, as long as no more than
+    max_hedge_rate of the requests sent so far have been hedged.
+
+    Args:
+        percentile (float): Latency percentile after which a request is hedged, e.g. 95
+        max_hedge_rate (float): Largest share of hedged requests, API_MAX_HEDGE_RATE by default
+    """
+
+    def __init__(self, percentile=95, max_hedge_rate=None):
+        self.percentile = percentile
+        self.max_hedge_rate = max_hedge_rate if max_hedge_rate is not None else API_MAX_HEDGE_RATE
+        self.latencies = deque(maxlen=LATENCY_HISTORY)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def record(self, latency):
+        self.latencies.append(latency)
+
+    def hedge_delay(self):
+        # Seconds after which a new request is hedged, None while there are too few samples
+        self.requests += 1
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        return float(np.percentile(self.latencies, self.percentile))
+
+    def try_hedge(self):
+        # Count a hedge if the hedge rate allows one more
+        if self.hedged + 1 > self.max_hedge_rate * self.requests:
+            return False
+        self.hedged += 1
+        return True
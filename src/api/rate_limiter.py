@@ -0,0 +1,170 @@
+"""
+Request and token rate limiting of LLM API calls, per model and API key
+"""
+import os
+import time
+import asyncio
+import threading
+from src.utils.env_utils import load_env_variables
+
+load_env_variables()
+
+# Default limits per (model, api_key), 0 means unlimited
+API_RPM = float(os.environ.get('API_RPM', '0'))
+API_TPM = float(os.environ.get('API_TPM', '0'))
+
+# Initial guesses, corrected from the usage data of responses
+CHARS_PER_TOKEN = 4.0
+COMPLETION_TOKENS = 256.0
+# Weight of the latest response in the corrected estimates
+USAGE_EMA_WEIGHT = 0.1
+
+
+class TokenBucket:
+    """
+    Bucket refilled at `rate_per_min` per minute, holding at most one minute of budget.
+
+    The level may go negative when a request turns out to use more than its
+    estimate; later requests then wait until the debt is refilled.
+    """
+
+    def __init__(self, rate_per_min):
+        self.rate_per_min = rate_per_min
+        self.capacity = rate_per_min
+        self.level = rate_per_min
+        self.last = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.last) * self.rate_per_min / 60)
+        self.last = now
+
+    def wait_time(self, amount):
+        # Seconds until `amount` can be taken, an amount over capacity only needs a full bucket
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing * 60 / self.rate_per_min)
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budget of one (model, api_key).
+
+    The tokens of a request are estimated from the length of its input text plus
+    the average completion length, and the estimate is corrected with the usage
+    reported in the response. Shared by threads and asyncio tasks.
+
+    Args:
+        rpm (float): Requests per minute, 0 or None for no limit
+        tpm (float): Tokens per minute, 0 or None for no limit
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self.lock = threading.Lock()
+        self.chars_per_token = CHARS_PER_TOKEN
+        self.completion_tokens = COMPLETION_TOKENS
+        self.requests = None
+        self.tokens = None
+        self.set_limits(rpm, tpm)
+
+    def set_limits(self, rpm=None, tpm=None):
+        # Only the given limits change (0 removes one), buckets whose rate is unchanged keep their level
+        with self.lock:
+            if rpm is not None:
+                self.requests = self.get_bucket(self.requests, rpm)
+            if tpm is not None:
+                self.tokens = self.get_bucket(self.tokens, tpm)
+
+    @staticmethod
+    def get_bucket(bucket, rate_per_min):
+        if not rate_per_min:
+            return None
+        if bucket is None or bucket.rate_per_min != rate_per_min:
+            return TokenBucket(rate_per_min)
+        return bucket
+
+    def estimate_tokens(self, text):
+        return len(text) / self.chars_per_token + self.completion_tokens
+
+    def try_acquire(self, tokens):
+        # Take one request and `tokens` tokens if both are available, otherwise return the wait in seconds
+        with self.lock:
+            now = time.monotonic()
+            wait = 0.0
+            for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+                if bucket is not None:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_time(amount))
+            if wait == 0.0:
+                if self.requests is not None:
+                    self.requests.level -= 1
+                if self.tokens is not None:
+                    self.tokens.level -= tokens
+            return wait
+
+    def acquire(self, text):
+        """
+        Block until a request with input `text` fits in the budget.
+
+        Returns:
+            float: The estimated tokens taken, to pass to record_usage
+        """
+        tokens = self.estimate_tokens(text)
+        while (wait := self.try_acquire(tokens)) > 0:
+            time.sleep(wait)
+        return tokens
+
+    async def acquire_async(self, text):
+        # Same as acquire, waiting without blocking the event loop
+        tokens = self.estimate_tokens(text)
+        while (wait := self.try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+        return tokens
+
+    def record_usage(self, text, estimated_tokens, usage=None):
+        """
+        Settle a request: charge its actual tokens instead of the estimate and
+        update the estimate from the usage reported by the API.
+
+        Args:
+            usage (dict): prompt_tokens / completion_tokens / total_tokens of the
+                response, or None if the request failed (the estimate is refunded)
+        """
+        with self.lock:
+            used = 0
+            if usage:
+                used = usage.get('total_tokens', 0)
+                if usage.get('prompt_tokens'):
+                    self.chars_per_token += USAGE_EMA_WEIGHT * (len(text) / usage['prompt_tokens'] - self.chars_per_token)
+                if usage.get('completion_tokens') is not None:
+                    self.completion_tokens += USAGE_EMA_WEIGHT * (usage['completion_tokens'] - self.completion_tokens)
+            if self.tokens is not None:
+                self.tokens.level += estimated_tokens - used
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model, api_key, rpm=None, tpm=None):
+    """
+    Get the shared rate limiter of a model and API key.
+
+    A new limiter starts from API_RPM and API_TPM of the environment. Each limit
+    given here replaces that limit of the limiter, the other one is kept.
+    """
+    key = (model, api_key)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(API_RPM, API_TPM)
+            _limiters[key] = limiter
+    limiter.set_limits(rpm, tpm)
+    return limiter
+
+
+def merge_limit(limit, other):
+    # The stricter of two per-minute limits sharing one budget, None if not given and 0 for no limit
+    if limit is None or other is None:
+        return other if limit is None else limit
+    if not limit or not other:
+        return limit or other
+    return min(limit, other)
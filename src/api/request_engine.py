@@ -0,0 +1,271 @@
+"""
+Concurrent request engine for sending many LLM queries of one run
+"""
+import time
+import heapq
+import random
+import asyncio
+from src.api.api_request_utils import get_response_async, close_async_clients, get_retry_after
+from src.api.circuit_breaker import CircuitBreaker
+from src.api.hedging import HedgePolicy
+from src.api.concurrency import get_concurrency_controller
+from src.api.response_cache import get_response_cache
+
+NETWORK_ERROR = "[Network Error]"
+
+
+class RequestEngine:
+    """
+    Send requests concurrently on an asyncio event loop. The number of requests
+    in flight follows the adaptive window of the model's ConcurrencyController,
+    which grows while responses are healthy and is cut on throttling, up to
+    max_in_flight.
+
+    Results are handed back in submission order, so callers can write them
+    to their output files exactly as a sequential loop would. A failed request
+    does not hold its slot while it waits: it goes to a retry queue and is sent
+    again after a jittered exponential backoff, or after the Retry-After delay
+    given by the API. A request that fails retry_threshold times gets
+    NETWORK_ERROR as its text. A streak of failures opens the circuit breaker,
+    which pauses new requests; only when the breaker gives up does the engine
+    stop and set `aborted`.
+
+    Successful responses are stored in the response cache, and a request whose
+    model and prompt are cached is answered from it without an API call.
+
+    With hedge set, a request still running after that percentile of recent
+    latencies is sent a second time; the first response is used and the other
+    request is cancelled (see HedgePolicy for the cap on hedged requests).
+
+    Args:
+        api_key (str): The API key for authentication
+        model (str): The model to use for generation
+        max_in_flight (int): Upper bound of the concurrency window
+        retry_threshold (int): Attempts per request
+        backoff_time (float): Base wait in seconds before the first retry, doubling per retry
+        max_backoff (float): Longest wait in seconds before a retry
+        cache (bool or str): False to bypass the response cache, "refresh" to send every
+            request and overwrite the cached responses
+        breaker (CircuitBreaker): Breaker of the run, a default one if None
+        hedge (float): Latency percentile after which requests are hedged, None to disable hedging
+    """
+
+    def __init__(self, api_key, model, max_in_flight=16, retry_threshold=5, backoff_time=2, max_backoff=60, cache=True, breaker=None, hedge=None):
+        self.api_key = api_key
+        self.model = model
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.retry_threshold = retry_threshold
+        self.backoff_time = backoff_time
+        self.max_backoff = max_backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.aborted = False
+        self.controller = get_concurrency_controller(model, api_key, self.max_in_flight)
+        self.cache = get_response_cache() if cache else None
+        self.cache_read = cache != "refresh"
+        self.cache_hits = 0
+        self.retried = 0
+        self.hedge = HedgePolicy(hedge) if hedge else None
+
+    def get_cached(self, content):
+        if self.cache is None or not self.cache_read:
+            return None
+        response = self.cache.get(self.model, content)
+        if response is None:
+            return None
+        self.cache_hits += 1
+        return response['choices'][0]['message']['content']
+
+    def retry_delay(self, attempt, error):
+        # Retry-After of the API if given, otherwise "equal jitter" exponential backoff
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff) * random.uniform(1.0, 1.1)
+        backoff = min(self.backoff_time * 2 ** (attempt - 1), self.max_backoff)
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    async def attempt(self, content):
+        """
+        Send one attempt of a request.
+
+        Returns:
+            tuple: (response text, None) on success, (None, exception) on failure
+        """
+        # Timed from when the rate limiter lets the request go, so local pacing is not taken for provider latency
+        sent = []
+
+        def on_send():
+            sent.append(time.monotonic())
+
+        try:
+            if self.hedge is None:
+                response = await get_response_async(self.api_key, self.model, content, on_send)
+            else:
+                response = await self.hedged_request(content, on_send, sent)
+        except Exception as e:
+            print(f"Error: {e}", flush=True)
+            self.controller.on_error(sent[0] if sent else time.monotonic(), e)
+            return None, e
+        self.controller.on_success(sent[0], time.monotonic() - sent[0])
+        if self.cache is not None:
+            self.cache.put(self.model, content, response)
+        return response['choices'][0]['message']['content'], None
+
+    async def hedged_request(self, content, on_send, sent):
+        """
+        Send the request, and a duplicate if it is slow; the first response wins.
+
+        The hedge timer starts when the rate limiter lets the first request go, so
+        a request that is only waiting for the limiter is never hedged. The latency
+        of the first request is recorded for the percentile, also when it loses
+        the race (then up to the time it is cancelled).
+        """
+        sent_event = asyncio.Event()
+
+        def on_first_send():
+            on_send()
+            sent_event.set()
+
+        first = asyncio.ensure_future(get_response_async(self.api_key, self.model, content, on_first_send))
+        delay = self.hedge.hedge_delay()
+        pending = {first}
+        try:
+            if delay is not None:
+                sent_wait = asyncio.ensure_future(sent_event.wait())
+                await asyncio.wait({first, sent_wait}, return_when=asyncio.FIRST_COMPLETED)
+                sent_wait.cancel()
+                if not first.done():
+                    await asyncio.wait({first}, timeout=max(0.0, sent[0] + delay - time.monotonic()))
+            if first.done() or delay is None or not self.hedge.try_hedge():
+                return await first
+
+            second = asyncio.ensure_future(get_response_async(self.api_key, self.model, content))
+            pending.add(second)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            if sent:
+                self.hedge.record(time.monotonic() - sent[0])
+            # Cancel the request that lost the race
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def run_async(self, jobs, on_result):
+        job_iter = enumerate(jobs)
+        jobs_left = True
+        done = {}
+        next_seq = 0
+        in_flight = 0
+        # Failed requests waiting for their retry, as (due time, seq, attempts, content, payload)
+        retry_queue = []
+        changed = asyncio.Condition()
+
+        def finish(seq, payload, text):
+            # Hand back every finished result that is next in submission order
+            nonlocal next_seq
+            done[seq] = (payload, text)
+            while next_seq in done:
+                on_result(*done.pop(next_seq))
+                next_seq += 1
+
+        async def next_request():
+            # Wait under the condition until a request may start, None when the run is over
+            nonlocal jobs_left, in_flight
+            while not self.aborted:
+                now = time.monotonic()
+                # Without a timeout the wait ends when a request finishes
+                wait = None
+                if in_flight < self.controller.limit:
+                    state = self.breaker.allow(now)
+                    if state is None:
+                        wait = self.breaker.wait_time(now) or None
+                    else:
+                        if retry_queue and retry_queue[0][0] <= now:
+                            _, seq, attempts, content, payload = heapq.heappop(retry_queue)
+                            in_flight += 1
+                            return seq, attempts, content, payload, state == "probe"
+                        while jobs_left:
+                            seq, (content, payload) = next(job_iter, (None, (None, None)))
+                            if seq is None:
+                                jobs_left = False
+                                break
+                            # Jobs without content (e.g. a failed test response) are passed through
+                            text = NETWORK_ERROR if content is None else self.get_cached(content)
+                            if text is not None:
+                                finish(seq, payload, text)
+                                continue
+                            in_flight += 1
+                            return seq, 0, content, payload, state == "probe"
+                        if state == "probe":
+                            self.breaker.cancel_probe()
+                        if retry_queue:
+                            wait = retry_queue[0][0] - now
+                if not jobs_left and not retry_queue and in_flight == 0:
+                    return None
+                try:
+                    await asyncio.wait_for(changed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            return None
+
+        async def worker():
+            nonlocal in_flight
+            while True:
+                async with changed:
+                    request = await next_request()
+                if request is None:
+                    break
+                seq, attempts, content, payload, probe = request
+                text, error = await self.attempt(content)
+                async with changed:
+                    in_flight -= 1
+                    now = time.monotonic()
+                    if error is None:
+                        self.breaker.on_success()
+                        finish(seq, payload, text)
+                    else:
+                        self.breaker.on_failure(now, probe)
+                        if self.breaker.aborted:
+                            self.aborted = True
+                        attempts += 1
+                        if attempts >= self.retry_threshold:
+                            finish(seq, payload, NETWORK_ERROR)
+                        else:
+                            self.retried += 1
+                            heapq.heappush(retry_queue, (now + self.retry_delay(attempts, error), seq, attempts, content, payload))
+                    changed.notify_all()
+
+        try:
+            await asyncio.gather(*[worker() for _ in range(self.max_in_flight)])
+            # After an abort the queued retries are written as failed, the unsent jobs are left out
+            while retry_queue:
+                _, seq, _, _, payload = heapq.heappop(retry_queue)
+                finish(seq, payload, NETWORK_ERROR)
+        finally:
+            await close_async_clients()
+
+    def run(self, jobs, on_result):
+        """
+        Send the requests of all jobs and hand back their results in job order.
+
+        Args:
+            jobs (iterable): (content, payload) pairs, read lazily as requests are started
+            on_result (callable): Called as on_result(payload, response_text) for each job, in job order
+
+        Returns:
+            bool: False if the run was aborted because the API stayed unavailable
+        """
+        asyncio.run(self.run_async(jobs, on_result))
+        print(f"Concurrency window of {self.model}: {self.controller.window:.1f}, cached responses used: {self.cache_hits}, "
+              f"retries: {self.retried}", flush=True)
+        if self.hedge is not None:
+            print(f"Hedged requests: {self.hedge.hedged} of {self.hedge.requests}, won by the hedge: {self.hedge.hedge_wins}", flush=True)
+        return not self.aborted
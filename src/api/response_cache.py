@@ -0,0 +1,139 @@
+"""
+Persistent cache of LLM API responses, keyed by model, prompt and sampling parameters
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from src.utils.env_utils import load_env_variables
+from src.core.paths import CACHE_DIR, safe_join_path
+
+load_env_variables()
+
+# Set API_CACHE=0 to disable the cache for every run
+API_CACHE = os.environ.get('API_CACHE', '1') != '0'
+API_CACHE_PATH = os.environ.get('API_CACHE_PATH', safe_join_path(CACHE_DIR, 'response_cache.sqlite'))
+# Seconds a response stays valid and total size of the cached responses, 0 means no limit
+API_CACHE_TTL = float(os.environ.get('API_CACHE_TTL', '0'))
+API_CACHE_MAX_MB = float(os.environ.get('API_CACHE_MAX_MB', '1024'))
+
+# Eviction removes the least recently used responses down to this share of the size limit
+EVICT_TARGET = 0.9
+
+
+def get_cache_key(model, content, params=None):
+    # sha256 of the model, prompt text and sampling parameters
+    key_data = json.dumps([model, content, params or {}], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite store of response dicts by get_cache_key.
+
+    Expired responses (older than ttl seconds) are dropped when they are read.
+    When the stored responses exceed max_bytes, the least recently read ones are
+    evicted. Several processes may share one cache file.
+
+    Args:
+        path (str): SQLite file of the cache
+        ttl (float): Seconds a response stays valid, 0 or None for no expiry
+        max_bytes (int): Size limit of the stored responses, 0 or None for no limit
+    """
+
+    def __init__(self, path, ttl=None, max_bytes=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, created REAL, accessed REAL, size INTEGER, response TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        # Running size of the stored responses, so a put does not have to sum the table
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, model, content, params=None):
+        """
+        Returns:
+            dict: The cached response dict, or None if it is missing or expired
+        """
+        key = get_cache_key(model, content, params)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT created, response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl and now - row[0] > self.ttl:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(row[1])
+
+    def put(self, model, content, response, params=None):
+        key = get_cache_key(model, content, params)
+        response_text = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        with self.lock:
+            # A refreshed response replaces its row, so the old size no longer counts
+            row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, created, accessed, size, response) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, now, now, len(response_text), response_text),
+            )
+            self.total_bytes += len(response_text) - (row[0] if row is not None else 0)
+            if self.max_bytes and self.total_bytes > self.max_bytes:
+                self.evict(self.max_bytes)
+
+    def evict(self, max_bytes):
+        # Called with the lock held: drop expired responses, then the least recently read ones
+        if self.ttl:
+            self.conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > max_bytes:
+            excess = total - max_bytes * EVICT_TARGET
+            # Rows in access order whose preceding rows have not yet freed the excess
+            self.conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM ("
+                "SELECT key, size, SUM(size) OVER (ORDER BY accessed, key) AS freed FROM responses"
+                ") WHERE freed - size < ?)",
+                (excess,),
+            )
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.total_bytes = total
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM responses")
+            self.total_bytes = 0
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Get the shared response cache of the process, or None if API_CACHE=0.
+    """
+    global _cache
+    if not API_CACHE:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(API_CACHE_PATH, API_CACHE_TTL, int(API_CACHE_MAX_MB * 1024 * 1024))
+    return _cache
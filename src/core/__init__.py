@@ -1,9 +1,10 @@
 """
 Core functionality for causal graph generation and manipulation
 """
-from src.core.graph_utils import dag_gen
+from src.core.graph_utils import dag_gen, dag_gen_batch, pack_adj_mat, get_adj_mat, GraphReach, d_separated, is_backdoor_set
 from src.core.conf_utils import conf_qa_gen, dict2text as conf_dict2text
 from src.core.cf_utils import cf_qa_gen, dict2text as cf_dict2text
+from src.core.dataset_session import DatasetSession
 from src.core.settings import (
     get_test_settings,
     get_data_gen_settings,
@@ -21,10 +22,17 @@ from src.core.paths import (
 
 __all__ = [
     'dag_gen', 
+    'dag_gen_batch',
+    'pack_adj_mat',
+    'get_adj_mat',
+    'GraphReach',
+    'd_separated',
+    'is_backdoor_set',
     'conf_qa_gen', 
     'cf_qa_gen',
     'conf_dict2text',
     'cf_dict2text',
+    'DatasetSession',
     'get_test_settings',
     'get_data_gen_settings',
     'PROJECT_ROOT',
@@ -1,85 +1,48 @@
 import random
+import itertools
 import numpy as np
 from src.utils import public_utils
+from src.core.graph_utils import GraphReach
 
 
-def dict2text(node_name, cf_qa_d, adj_mat):
-    clue_node_name = [node_name[i] for i in cf_qa_d['cf_clue']]
-    node_opt = cf_qa_d['node_opt']  # opt_str = ["not", "", "and", "or"]
-    node_indegree = np.sum(adj_mat, axis=0, dtype=int)
-    node_n = len(node_indegree)
+def text_plan(adj_mat):
+    # Parents of every node, read from the adjacency matrix once per graph
+    return [np.flatnonzero(col).tolist() for col in adj_mat.T]
 
-    c_relation_line = ""
-    for i in range(node_n):
-        if np.sum(node_indegree[i]) > 0:
-            node_opt_t_head = "The " + node_name[i] + " happens if "
-            opt_idx = 0
-            node_opt_t = ""
-            for j in range(0, i):
-                if adj_mat[j][i] == 1:
-                    if node_opt[i][opt_idx] == 0:
-                        edge_opt_t = "the " + node_name[j] + " not happen"
-                    else:
-                        edge_opt_t = "the " + node_name[j] + " happens"
-
-                    node_opt_t += edge_opt_t
-                    if opt_idx < len(node_opt[i])-1 and node_opt[i][opt_idx+1] == 2:
-                        node_opt_t += " and "
-                    else:
-                        c_relation_line += node_opt_t_head + node_opt_t + ".\n"
-                        node_opt_t = ""
 
-                    opt_idx += 2
-        else:
-            if node_name[i] not in clue_node_name:
-                c_relation_line += "The " + node_name[i] + " is bound to happen.\n"
-    c_relation_line = '\n'.join(c_relation_line.split('\n')[:-1])
-
-    clue_line = "We have observed "
-    for i in range(len(clue_node_name)):
-        clue_line += "the " + clue_node_name[i] + " happened"
-        if len(clue_node_name) > 1:
-            if i == len(clue_node_name)-2:
-                clue_line += " and "
-            elif i != len(clue_node_name)-1:
-                clue_line += ", "
-    clue_line += "."
-
-    f_query_line = "What about the "
-    cf_query_name = [node_name[i] for i in cf_qa_d['cf_query']]
-    cf_query_line = "What the "
-    for i in range(len(cf_query_name)):
-        cf_query_line += cf_query_name[i]
-        f_query_line += cf_query_name[i]
-        if len(cf_query_name) > 1:
-            if i == len(cf_query_name)-2:
-                cf_query_line += " and "
-                f_query_line += " and "
-            elif i != len(cf_query_name)-1:
-                cf_query_line += ", "
-                f_query_line += ", "
-    f_query_line += "? "
-    cf_query_line += " would be "
-
-    cf_assign_whatif = [cf_qa_d['cf_assign'][i] for i in cf_qa_d['cf_whatif']]
-    whatif_node_name = [node_name[i] for i in cf_qa_d['cf_whatif']]
-    whatif_line = "if "
-    for i in range(len(whatif_node_name)):
-        if cf_assign_whatif[i]:
-            whatif_line += "the " + whatif_node_name[i] + " happened"
-        else:
-            whatif_line += "the " + whatif_node_name[i] + " didn't happen"
-        if len(whatif_node_name) > 1:
-            if i == len(whatif_node_name)-2:
-                whatif_line += " and "
-            elif i != len(whatif_node_name)-1:
-                whatif_line += ", "
-    whatif_line += "?"
+def dict2text(node_name, cf_qa_d, adj_mat, plan=None):
+    if plan is None:
+        plan = text_plan(adj_mat)
+    clue_node_name = [node_name[i] for i in cf_qa_d['cf_clue']]
+    node_opt = cf_qa_d['node_opt']  # opt_str = ["not", "", "and", "or"]
 
-    # query_text = c_relation_line + '\n' + clue_line + f_query_line + cf_query_line + whatif_line
+    # Parents joined by "and" share a line, "or" starts a new one
+    c_relation_lines = []
+    for i, parents in enumerate(plan):
+        if parents:
+            opt = node_opt[i]
+            terms = []
+            for k, j in enumerate(parents):
+                terms.append("the " + node_name[j] + (" not happen" if opt[2*k] == 0 else " happens"))
+                if 2*k+1 >= len(opt) or opt[2*k+1] != 2:
+                    c_relation_lines.append("The " + node_name[i] + " happens if " + " and ".join(terms) + ".")
+                    terms = []
+        elif node_name[i] not in clue_node_name:
+            c_relation_lines.append("The " + node_name[i] + " is bound to happen.")
+    c_relation_line = "\n".join(c_relation_lines)
+
+    clue_line = "We have observed " + public_utils.join_names(["the " + n + " happened" for n in clue_node_name]) + "."
+
+    cf_query_name = public_utils.join_names([node_name[i] for i in cf_qa_d['cf_query']])
+    f_query_line = "What about the " + cf_query_name + "? "
+    cf_query_line = "What the " + cf_query_name + " would be "
+
+    whatif_line = "if " + public_utils.join_names([
+        "the " + node_name[i] + (" happened" if cf_qa_d['cf_assign'][i] else " didn't happen")
+        for i in cf_qa_d['cf_whatif']
+    ]) + "?"
 
     return c_relation_line, clue_line, f_query_line, cf_query_line, whatif_line
-    # return query_text
 
 
 def get_node_opts(adj_mat):
@@ -116,68 +79,178 @@ def get_node_opts(adj_mat):
     return node_opt_list
 
 
-def cf_bool_assign(adj_mat, node_opt_list, whatif_node=None, fact_assign=None):
-    py_code = "def cf_bool_code():\n"
+def compile_bool_circuit(adj_mat, node_opt_list):
+    """
+    Compile the boolean operators of a graph into an array program.
+
+    A node's rule reads like "not a and b or c", which Python evaluates as
+    (not a and b) or c, so every node is an OR of AND-groups of possibly negated
+    parents. The program lists, in topological order, each node with its parents,
+    their negation mask and the start index of every AND-group. Nodes without
+    parents take their value from the assignment the program is evaluated with.
+
+    Returns:
+        list: (node, parents, negate, group_start) per node, with parents None for root nodes
+    """
+    adj_mat = np.asarray(adj_mat, dtype=bool)
+    node_indegree = np.sum(adj_mat, axis=0, dtype=int)
+    node_n = len(node_indegree)
+
+    # Kahn's algorithm, taking the smallest ready node first
+    remaining = node_indegree.copy()
+    ready = np.flatnonzero(remaining == 0).tolist()
+    order = []
+    while ready:
+        node = min(ready)
+        ready.remove(node)
+        order.append(node)
+        for child in np.flatnonzero(adj_mat[node]):
+            remaining[child] -= 1
+            if remaining[child] == 0:
+                ready.append(child)
+
+    circuit = []
+    for i in order:
+        if node_indegree[i] == 0:
+            circuit.append((i, None, None, None))
+        else:
+            node_opt = np.asarray(node_opt_list[i])
+            parents = np.flatnonzero(adj_mat[:, i])
+            negate = node_opt[::2] == 0  # 0 = not, 1 = is/eql
+            group_start = np.flatnonzero(np.r_[True, node_opt[1::2] == 3])  # 2 = and, 3 = or
+            circuit.append((i, parents, negate, group_start))
+
+    return circuit
+
+
+def eval_bool_circuit(circuit, root_assign, intervene=None):
+    """
+    Evaluate a compiled circuit for a batch of root assignments.
+
+    Args:
+        circuit: Program from compile_bool_circuit
+        root_assign: Boolean array of shape (batch, node_n) or (node_n,); only the
+            values of root and intervened nodes are read
+        intervene: Optional boolean mask of the same shape. Intervened nodes keep
+            their root_assign value instead of being computed from their parents,
+            as if their incoming edges were cut.
+
+    Returns:
+        numpy.ndarray: Boolean node values of shape (batch, node_n)
+    """
+    values = np.array(root_assign, dtype=bool, ndmin=2)
+    if intervene is not None:
+        intervene = np.broadcast_to(np.asarray(intervene, dtype=bool), values.shape)
+    for i, parents, negate, group_start in circuit:
+        if parents is not None:
+            literal = values[:, parents] ^ negate
+            computed = np.logical_and.reduceat(literal, group_start, axis=1).any(axis=1)
+            if intervene is None:
+                values[:, i] = computed
+            else:
+                values[:, i] = np.where(intervene[:, i], values[:, i], computed)
+
+    return values
+
+
+def render_bool_expr(adj_mat, node_opt_list, whatif_node=None, fact_assign=None):
+    # Render the node rules as "var_x = ..." lines, the bool_expr stored with cf queries
     bool_expr = ""
     node_indegree = np.sum(adj_mat, axis=0, dtype=int)
     node_n = len(node_indegree)
     opt_str = ["not", "", "and", "or"]
-    output_code = "\treturn ["
 
     for i in range(node_n):
         if node_indegree[i] == 0:
-            if whatif_node is None:
-                py_code += '\t' + public_utils.int2str(i) + " = True\n"
-                bool_expr += public_utils.int2str(i) + " = True\n"
+            if whatif_node is not None and i in whatif_node:
+                bool_expr += public_utils.int2str(i) + " = " + str(not fact_assign[i]) + "\n"
             else:
-                if i in whatif_node:
-                    cf_bool = not fact_assign[i]
-                    py_code += '\t' + public_utils.int2str(i) + " = " + str(cf_bool) + "\n"
-                    bool_expr += public_utils.int2str(i) + " = " + str(cf_bool) + "\n"
-                else:
-                    py_code += '\t' + public_utils.int2str(i) + " = True\n"
-                    bool_expr += public_utils.int2str(i) + " = True\n"
+                bool_expr += public_utils.int2str(i) + " = True\n"
 
         else:
-            code_line = '\t' + public_utils.int2str(i) + " = "
+            code_line = public_utils.int2str(i) + " = "
             opt_idx = 0
             for k in range(node_n):  # Check the indegree of the node
                 if adj_mat[k][i] == 1:  # If path exist
+                    if node_opt_list[i][opt_idx] != 1:
+                        code_line += opt_str[node_opt_list[i][opt_idx]] + " " + public_utils.int2str(k)
+                    else:
+                        code_line += opt_str[node_opt_list[i][opt_idx]] + public_utils.int2str(k)
                     if opt_idx < len(node_opt_list[i])-1:
-                        if node_opt_list[i][opt_idx] != 1:
-                            code_line += opt_str[node_opt_list[i][opt_idx]] + " " + public_utils.int2str(k) + " "
-                        else:
-                            code_line += opt_str[node_opt_list[i][opt_idx]] + public_utils.int2str(k) + " "
-                        code_line += opt_str[node_opt_list[i][opt_idx+1]] + " "
+                        code_line += " " + opt_str[node_opt_list[i][opt_idx+1]] + " "
                         opt_idx += 2
                     else:
-                        if node_opt_list[i][opt_idx] != 1:
-                            code_line += opt_str[node_opt_list[i][opt_idx]] + " " + public_utils.int2str(k) + "\n"
-                        else:
-                            code_line += opt_str[node_opt_list[i][opt_idx]] + public_utils.int2str(k) + "\n"
+                        code_line += "\n"
+            bool_expr += code_line
+
+    return bool_expr
 
-            py_code += code_line
-            bool_expr += code_line.split('\t')[1]
 
-        output_code += public_utils.int2str(i)
-        if i != node_n-1:
-            output_code += ", "
+def cf_bool_assign(adj_mat, node_opt_list, whatif_node=None, fact_assign=None, render_expr=True):
+    """
+    Assign the boolean value of every node.
 
-    output_code += "]\n"
-    py_code += output_code + "result = cf_bool_code()"
-    global_env, local_env = {}, {}
-    exec(py_code, global_env, local_env)
-    bool_value = local_env['result']
+    Root nodes are True, except the whatif nodes, which take the opposite of their
+    value in fact_assign.
+
+    Returns:
+        tuple: (bool_expr, bool_value), bool_expr is None unless render_expr is set
+    """
+    circuit = compile_bool_circuit(adj_mat, node_opt_list)
+    root_assign = np.ones(len(node_opt_list), dtype=bool)
+    if whatif_node is not None:
+        for i in whatif_node:
+            root_assign[i] = not fact_assign[i]
+    bool_value = eval_bool_circuit(circuit, root_assign)[0].tolist()
+    bool_expr = render_bool_expr(adj_mat, node_opt_list, whatif_node, fact_assign) if render_expr else None
 
     return bool_expr, bool_value
 
 
-def cf_qa_gen(node_tier, adj_mat, whatif_n):  # the node number in the node_tire must be sorted
-    observed_node = []
-    in_degree = np.sum(adj_mat, axis=0, dtype=int)
-    for i in range(len(in_degree)):
-        if in_degree[i] == 0:
-            observed_node.append(i)
+def intervention_table(circuit, node_n, candidates, max_k):
+    """
+    Evaluate every intervention of up to max_k candidate nodes in one pass.
+
+    An intervention flips the chosen nodes away from their factual value and cuts
+    their incoming edges, as in a counterfactual "what if" question.
+
+    Returns:
+        tuple: (whatif_sets, table) where whatif_sets[0] is the empty set and
+        table[s] holds the node values under whatif_sets[s], so table[0] is the
+        factual assignment
+    """
+    f_value = eval_bool_circuit(circuit, np.ones(node_n, dtype=bool))[0]
+    whatif_sets = [()]
+    for k in range(1, min(max_k, len(candidates)) + 1):
+        whatif_sets.extend(itertools.combinations(candidates, k))
+
+    intervene = np.zeros((len(whatif_sets), node_n), dtype=bool)
+    for s, whatif_set in enumerate(whatif_sets):
+        intervene[s, list(whatif_set)] = True
+    table = eval_bool_circuit(circuit, np.where(intervene, ~f_value, True), intervene)
+
+    return whatif_sets, table
+
+
+def cf_qa_gen_all(node_tier, adj_mat, whatif_n_list, reach=None, select="any"):  # the node number in the node_tire must be sorted
+    """
+    Generate the counterfactual queries of one graph, one per whatif_n.
+
+    The queries share the graph's node operators, and all their candidate whatif
+    sets are evaluated together by intervention_table.
+
+    Args:
+        reach: GraphReach of adj_mat, shared between the queries of one graph
+        select: "any" samples whatif sets uniformly, "flip" samples among the sets
+            that change at least one query node (falling back to "any" if none does)
+
+    Returns:
+        list: One cf_qa dict per entry of whatif_n_list
+    """
+    if reach is None:
+        reach = GraphReach(adj_mat)
+    observed_node = reach.roots
+    in_degree = reach.in_degree
     query_node = []
     for n in node_tier[-1]:
         if in_degree[n] != 0:
@@ -189,20 +262,35 @@ def cf_qa_gen(node_tier, adj_mat, whatif_n):  # the node number in the node_tire
                 whatif_candidates.append(n)
 
     node_opt = get_node_opts(adj_mat)
-
-    if whatif_n <= len(whatif_candidates):
-        whatif_node = random.sample(whatif_candidates, whatif_n)
-    else:
-        whatif_node = random.sample(whatif_candidates, len(whatif_candidates))
-
-    adj_mat_cf = adj_mat.copy()
-    for i in whatif_node:
-        adj_mat_cf[:, i] = 0
-
-    f_bool_expr, f_assign = cf_bool_assign(adj_mat, node_opt)
-    cf_bool_expr, cf_assign = cf_bool_assign(adj_mat_cf, node_opt, whatif_node, f_assign)
-
-    cf_qa = {'wi_n': whatif_n, 'node_opt': node_opt,  'cf_clue': observed_node, 'cf_whatif': whatif_node, 'cf_query': query_node,
-             'f_bool_expr': f_bool_expr, 'f_assign': f_assign, 'cf_bool_expr': cf_bool_expr, 'cf_assign': cf_assign}
-
-    return cf_qa
+    node_n = len(node_opt)
+    circuit = compile_bool_circuit(adj_mat, node_opt)
+    whatif_sets, table = intervention_table(circuit, node_n, whatif_candidates, max(whatif_n_list))
+    set_size = np.array([len(w) for w in whatif_sets])
+    query_flip = (table[:, query_node] != table[0, query_node]).any(axis=1)
+    f_assign = table[0].tolist()
+    f_bool_expr = render_bool_expr(adj_mat, node_opt)
+
+    cf_qa_list = []
+    for whatif_n in whatif_n_list:
+        candidate_sets = np.flatnonzero(set_size == min(whatif_n, len(whatif_candidates)))
+        if select == "flip" and query_flip[candidate_sets].any():
+            candidate_sets = candidate_sets[query_flip[candidate_sets]]
+        s = candidate_sets[random.randrange(len(candidate_sets))]
+        whatif_node = list(whatif_sets[s])
+
+        adj_mat_cf = adj_mat.copy()
+        for i in whatif_node:
+            adj_mat_cf[:, i] = 0
+        cf_assign = table[s].tolist()
+        cf_bool_expr = render_bool_expr(adj_mat_cf, node_opt, whatif_node, f_assign)
+
+        cf_qa = {'wi_n': whatif_n, 'node_opt': node_opt,  'cf_clue': observed_node, 'cf_whatif': whatif_node, 'cf_query': query_node,
+                 'f_bool_expr': f_bool_expr, 'f_assign': f_assign, 'cf_bool_expr': cf_bool_expr, 'cf_assign': cf_assign,
+                 'query_flip': bool(query_flip[s])}
+        cf_qa_list.append(cf_qa)
+
+    return cf_qa_list
+
+
+def cf_qa_gen(node_tier, adj_mat, whatif_n, reach=None, select="any"):
+    return cf_qa_gen_all(node_tier, adj_mat, [whatif_n], reach, select)[0]
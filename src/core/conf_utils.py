@@ -1,59 +1,34 @@
 from src.utils import public_utils
+from src.core.graph_utils import GraphReach
 import numpy as np
 
 
-def dict2text(node_name, conf_qa_d, adj_mat):
+def text_plan(adj_mat):
+    # Children of every node, read from the adjacency matrix once per graph
+    return [np.flatnonzero(row).tolist() for row in adj_mat]
+
+
+def dict2text(node_name, conf_qa_d, adj_mat, plan=None):
+    if plan is None:
+        plan = text_plan(adj_mat)
+    c_relations_line = "\n".join(
+        node_name[i][0].upper() + node_name[i][1:] + " has a causal effect on " + public_utils.join_names([node_name[j] for j in children]) + "."
+        for i, children in enumerate(plan) if children
+    )
+
     c_list = conf_qa_d['c_list']
     e_list = conf_qa_d['e_list']
-    n_rows, n_cols = adj_mat.shape
-    c_relations_line = ""
-    for i in range(n_rows):
-        target_nodes = adj_mat[i, :]
-        target_nodes_n = np.sum(target_nodes)
-        target_nodes_remain = target_nodes_n
-        if target_nodes_n > 1:
-            c_relations_line += node_name[i][0].upper() + node_name[i][1:] + " has a causal effect on "
-            for j in range(i, n_rows):
-                if adj_mat[i][j] == 1:
-                    if target_nodes_remain > 2:
-                        c_relations_line += node_name[j] + ", "
-                    elif target_nodes_remain == 2:
-                        c_relations_line += node_name[j] + " and "
-                    else:
-                        c_relations_line += node_name[j] + ".\n"
-                    target_nodes_remain -= 1
-        else:
-            for j in range(i, n_rows):
-                if adj_mat[i][j] == 1:
-                    c_relations_line += node_name[i][0].upper() + node_name[i][1:] + " has a causal effect on " + node_name[j] + ".\n"
-    c_relations_line = '\n'.join(c_relations_line.split('\n')[:-1])
-
-    ce_query_line = "We want to estimate the causal effect of the"
-    if len(c_list) > 1:
-        ce_query_line += "s "
-    for i in range(len(c_list)):
-        ce_query_line += node_name[c_list[i]]
-        if len(c_list) > 1:
-            if i == len(c_list) - 2:
-                ce_query_line += " and "
-            elif i != len(c_list) - 1:
-                ce_query_line += ", "
-    ce_query_line += " on the"
-    if len(e_list) > 1:
-        ce_query_line += "s "
-    for i in range(len(e_list)):
-        ce_query_line += node_name[e_list[i]]
-        if len(e_list) > 1:
-            if i == len(e_list) - 2:
-                ce_query_line += " and "
-            elif i != len(e_list) - 1:
-                ce_query_line += ", "
-    ce_query_line += "."
+    ce_query_line = (
+        "We want to estimate the causal effect of the" + ("s " if len(c_list) > 1 else "")
+        + public_utils.join_names([node_name[c] for c in c_list])
+        + " on the" + ("s " if len(e_list) > 1 else "")
+        + public_utils.join_names([node_name[e] for e in e_list]) + "."
+    )
 
     return c_relations_line, ce_query_line
 
 
-def conf_qa_gen(node_tier, adj_mat, ce_d):
+def get_ce_list(node_tier, ce_d):
     # Define causal tier and effect tier by relative distance
     max_d = len(node_tier[1:-1])
     offset = round(max_d/2*(1-ce_d))
@@ -63,21 +38,127 @@ def conf_qa_gen(node_tier, adj_mat, ce_d):
     else:
         e_list = node_tier[-2-offset]
 
-    # Find causal paths and non-causal paths
-    c2e_path = []
-    c2e_noncausal_path = []
-    undir_adj_mat = adj_mat + adj_mat.T
+    return c_list, e_list
+
+
+def ce_connected(reach, c, e, directed=True):
+    # A cause in the effect tier (c == e, e.g. ce_d=0.5 on 5 tiers) has the one-node path [c]
+    if c == e:
+        return True
+    return reach.desc[c, e] if directed else reach.undir_conn[c, e]
+
+
+def conf_path_count(node_tier, adj_mat, ce_d, limit=None, reach=None, noncausal_path=False):
+    """
+    Count the paths conf_qa_gen would enumerate for one ce_d.
+
+    Without noncausal_path this is the number of causal paths over all cause/effect
+    pairs, counted with a dynamic program and without listing any path. With it,
+    every causal path is also a path of the undirected graph, so it is the number
+    of undirected paths; those have no such recurrence and are enumerated until
+    the count exceeds `limit`.
+    """
+    if reach is None:
+        reach = GraphReach(adj_mat)
+    c_list, e_list = get_ce_list(node_tier, ce_d)
+    undir_adj_mat = reach.adj | reach.adj.T
+    path_n = 0
     for c in c_list:
         for e in e_list:
-            c2e_path_t = public_utils.find_all_paths(adj_mat, c, e)
-            c2e_path.append(c2e_path_t)
-            c2e_undir_path_t = public_utils.find_all_paths(undir_adj_mat, c, e)
-            c2e_undir_path_woc2e = []
-            for i in c2e_undir_path_t:
-                if i not in c2e_path_t:
-                    c2e_undir_path_woc2e.append(i)
-            c2e_noncausal_path.append(c2e_undir_path_woc2e)
+            if not noncausal_path:
+                path_n += public_utils.count_paths(reach.adj, c, e) if ce_connected(reach, c, e) else 0
+            elif ce_connected(reach, c, e, directed=False):
+                remaining = None if limit is None else limit - path_n
+                path_n += public_utils.count_paths(undir_adj_mat, c, e, directed=False, limit=remaining,
+                                                   can_reach=reach.reach_mask(e, directed=False))
+            if limit is not None and path_n > limit:
+                return path_n
 
-    conf_qa = {'ce_d': ce_d, 'c_list': c_list, 'e_list': e_list, 'c2e_path': c2e_path, 'c2e_noncausal_path': c2e_noncausal_path}
+    return path_n
+
+
+def conf_qa_gen(node_tier, adj_mat, ce_d, reach=None, noncausal_path=False, limit=None):
+    # reach: GraphReach of adj_mat, shared between the queries of one graph
+    # noncausal_path: also enumerate and store c2e_noncausal_path. Backdoor answers are
+    # validated by d-separation, so this is only needed for analysing the paths.
+    # limit: return None instead once more than `limit` paths (as counted by
+    # conf_path_count) would be stored
+    if reach is None:
+        reach = GraphReach(adj_mat)
+    c_list, e_list = get_ce_list(node_tier, ce_d)
+    # Causal paths are counted without listing them, so an oversized graph is never walked
+    if limit is not None and not noncausal_path and conf_path_count(node_tier, adj_mat, ce_d, limit, reach) > limit:
+        return None
+
+    # Find causal paths and non-causal paths, stored per c/e pair as they are enumerated
+    c2e_path = public_utils.PathSet()
+    c2e_noncausal_path = public_utils.PathSet()
+    undir_adj_mat = reach.adj | reach.adj.T
+    path_n = 0
+    for c in c_list:
+        for e in e_list:
+            c2e_path.add_pair()
+            c2e_noncausal_path.add_pair()
+            if not noncausal_path:
+                if ce_connected(reach, c, e):
+                    for i in public_utils.iter_all_paths(reach.adj, c, e, reach.reach_mask(e)):
+                        c2e_path.add_path(i)
+            elif ce_connected(reach, c, e, directed=False):
+                # One walk of the undirected graph; a path is causal when all its edges point forward.
+                # Both walks are depth-first in node order, so the causal paths keep their order.
+                causal = ce_connected(reach, c, e)
+                for i in public_utils.iter_all_paths(undir_adj_mat, c, e, reach.reach_mask(e, directed=False)):
+                    path_n += 1
+                    if limit is not None and path_n > limit:
+                        return None
+                    if causal and reach.adj[i[:-1], i[1:]].all():
+                        c2e_path.add_path(i)
+                    else:
+                        c2e_noncausal_path.add_path(i)
+    c2e_path.finish()
+    c2e_noncausal_path.finish()
+
+    conf_qa = {'ce_d': ce_d, 'c_list': c_list, 'e_list': e_list, 'c2e_path': c2e_path}
+    if noncausal_path:
+        conf_qa['c2e_noncausal_path'] = c2e_noncausal_path
 
     return conf_qa
+
+
+def conf_qa_gen_all(node_tier, adj_mat, ce_d_list, reach=None, noncausal_path=False, limit=None):
+    """
+    Generate the confounding queries of one graph, one per ce_d, within one path budget.
+
+    Causal paths are counted with the dynamic program for every ce_d before any of
+    them is enumerated. Undirected paths have no such count, so with noncausal_path
+    the queries are enumerated in turn against what is left of the budget, and at
+    most `limit` paths are walked in total.
+
+    Args:
+        reach: GraphReach of adj_mat, shared between the queries of one graph
+        limit (int): Most paths stored over all queries of the graph, None for no limit
+
+    Returns:
+        list: One conf_qa dict per entry of ce_d_list, or None if the graph has more
+            than `limit` paths
+    """
+    if reach is None:
+        reach = GraphReach(adj_mat)
+    if limit is not None and not noncausal_path:
+        path_n = 0
+        for ce_d in ce_d_list:
+            path_n += conf_path_count(node_tier, adj_mat, ce_d, limit - path_n, reach)
+            if path_n > limit:
+                return None
+        limit = None
+
+    conf_qa_list = []
+    for ce_d in ce_d_list:
+        conf_qa = conf_qa_gen(node_tier, adj_mat, ce_d, reach, noncausal_path, limit)
+        if conf_qa is None:
+            return None
+        if limit is not None:
+            limit -= conf_qa['c2e_path'].path_n + conf_qa['c2e_noncausal_path'].path_n
+        conf_qa_list.append(conf_qa)
+
+    return conf_qa_list
@@ -0,0 +1,101 @@
+"""
+In-memory view of the generated data of one graph_shape_group, shared by testing,
+answer extraction and evaluation
+"""
+import numpy as np
+from src.utils import public_utils, store_utils
+from src.core.paths import safe_join_path
+from src.core.graph_utils import GraphReach
+from src.core import conf_utils, cf_utils
+
+
+def get_query_name_type(query_type, name_type):
+    # Counterfactual queries name their nodes by the change of the named factor
+    if query_type[0:2] == "cf" and name_type != "specific":
+        return name_type + "_c"
+    return name_type
+
+
+class DatasetSession:
+    """
+    Graph, node name and query data of one graph_shape_group, loaded once.
+
+    Node names are read in one pass when the session is opened. Adjacency matrices
+    are views of the memory-mapped adjacency tensor of the group, so sessions of
+    several processes share its pages; groups without a tensor read each matrix
+    from the graph pickle once. Queries are read per query kind ("conf" or "cf") on first use. Derived
+    data (reachability, text plans, rendered query text) is cached per gid or
+    query id, so every (task, name_type, prompt) run of a model reuses it.
+
+    Args:
+        data_folder: Folder holding the generated pickle files
+        graph_shape_group: Group suffix of the pickle file names, e.g. "00"
+    """
+
+    def __init__(self, data_folder, graph_shape_group):
+        self.data_folder = data_folder
+        self.graph_shape_group = graph_shape_group
+
+        self.adj_store = store_utils.open_adj_store(self.data_path("graph_data"))
+        with store_utils.IndexedPickleStore(self.data_path("node_name_data")) as name_store:
+            self.name_items = {name_item["gid"]: name_item for name_item in name_store}
+        # Matrices unpacked from the graph pickle, only used without an adjacency tensor
+        self.adj_mats = {}
+
+        self.queries = {}
+        self.reaches = {}
+        self.text_plans = {}
+        self.rendered = {}
+        # Base query text by (query_type, name_type, query id), shared by the prompt types of a test
+        self.query_texts = {}
+
+    def data_path(self, prefix):
+        return safe_join_path(self.data_folder, f"{prefix}_{self.graph_shape_group}.pkl")
+
+    def query_data(self, kind):
+        # Queries of one kind ("conf" or "cf") by query id, in file order
+        if kind not in self.queries:
+            with store_utils.IndexedPickleStore(self.data_path(f"{kind}_query_data")) as query_store:
+                self.queries[kind] = {query_id: query_dict for query_id, query_dict in zip(query_store.keys(), query_store)}
+        return self.queries[kind]
+
+    def has_graph(self, gid):
+        return gid in self.adj_store and gid in self.name_items
+
+    def adj_mat(self, gid):
+        # Read-only view into the adjacency tensor, no copy is made
+        if isinstance(self.adj_store, store_utils.AdjTensor):
+            return self.adj_store[gid]
+        if gid not in self.adj_mats:
+            self.adj_mats[gid] = np.asarray(self.adj_store[gid], dtype=bool)
+        return self.adj_mats[gid]
+
+    def node_names(self, gid, name_type):
+        return public_utils.get_node_names(self.name_items[gid], name_type)
+
+    def reach(self, gid):
+        if gid not in self.reaches:
+            self.reaches[gid] = GraphReach(self.adj_mat(gid))
+        return self.reaches[gid]
+
+    def text_plan(self, kind, gid):
+        key = (kind, gid)
+        if key not in self.text_plans:
+            plan_fn = conf_utils.text_plan if kind == "conf" else cf_utils.text_plan
+            self.text_plans[key] = plan_fn(self.adj_mat(gid))
+        return self.text_plans[key]
+
+    def render(self, kind, query_id, name_type):
+        """
+        Render the graph and question lines of one query with dict2text, once per session.
+
+        Returns:
+            tuple: conf_utils.dict2text or cf_utils.dict2text output
+        """
+        key = (kind, query_id, name_type)
+        if key not in self.rendered:
+            gid = query_id[:8]
+            d2t_fn = conf_utils.dict2text if kind == "conf" else cf_utils.dict2text
+            self.rendered[key] = d2t_fn(self.node_names(gid, name_type), self.query_data(kind)[query_id],
+                                        self.adj_mat(gid), self.text_plan(kind, gid))
+        return self.rendered[key]
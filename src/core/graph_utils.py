@@ -19,6 +19,133 @@ def graph_complexity_count(matrix):
     return node_n, indegree_avg, chain_n, fork_n, collider_n
 
 
+def pack_adj_mat(matrix):
+    # Adjacency matrices are 0/1, so each row is stored as packed bits
+    return np.packbits(np.asarray(matrix, dtype=bool), axis=1)
+
+
+def get_adj_mat(graph_item):
+    """
+    Get the adjacency matrix of a graph record as a boolean array.
+
+    Works for compact records ('mat_bits', see pack_adj_mat) as well as records
+    holding a dense 'mat'.
+    """
+    if 'mat_bits' in graph_item:
+        return np.unpackbits(graph_item['mat_bits'], axis=1, count=graph_item['node_n']).view(bool)
+    return np.asarray(graph_item['mat']).astype(bool)
+
+
+def transitive_closure(adj_mat):
+    # Repeated boolean squaring: after k rounds, paths of length up to 2^k are covered
+    closure = np.asarray(adj_mat, dtype=bool)
+    while True:
+        extended = closure | (closure @ closure)
+        if np.array_equal(extended, closure):
+            return closure
+        closure = extended
+
+
+class GraphReach:
+    """
+    Reachability structure of one DAG, computed once per graph.
+
+    Query generators and validators share it instead of re-deriving degrees and
+    connectivity from the raw adjacency matrix for every query.
+
+    Attributes:
+        adj: Boolean adjacency matrix
+        in_degree, out_degree: Node degrees
+        desc: desc[i, j] is True if there is a directed path from i to j
+        anc: Transpose of desc, anc[i, j] is True if j is an ancestor of i
+        undir_conn: undir_conn[i, j] is True if i and j are connected when edge
+            directions are ignored
+    """
+
+    def __init__(self, adj_mat):
+        self.adj = np.asarray(adj_mat, dtype=bool)
+        self.node_n = self.adj.shape[0]
+        self.in_degree = np.sum(self.adj, axis=0, dtype=int)
+        self.out_degree = np.sum(self.adj, axis=1, dtype=int)
+        self.desc = transitive_closure(self.adj)
+        self.anc = self.desc.T
+        self.undir_conn = transitive_closure(self.adj | self.adj.T)
+
+    @property
+    def roots(self):
+        return np.flatnonzero(self.in_degree == 0).tolist()
+
+    def parents(self, node):
+        return np.flatnonzero(self.adj[:, node]).tolist()
+
+    def reach_mask(self, end_node, directed=True):
+        """Mask of the nodes from which end_node can be reached (end_node included)."""
+        mask = self.anc[end_node].copy() if directed else self.undir_conn[end_node].copy()
+        mask[end_node] = True
+        return mask
+
+
+def d_separated(adj_mat, xs, ys, zs):
+    """
+    Check whether node sets xs and ys are d-separated given zs (Bayes-ball).
+
+    Runs a single reachability pass over (node, direction) states, so it is linear
+    in the size of the graph instead of enumerating paths.
+    """
+    adj_mat = np.asarray(adj_mat, dtype=bool)
+    parents = [np.flatnonzero(col).tolist() for col in adj_mat.T]
+    children = [np.flatnonzero(row).tolist() for row in adj_mat]
+    ys, zs = set(ys), set(zs)
+
+    # Colliders are open when they or one of their descendants is observed
+    z_anc = set(zs)
+    frontier = list(zs)
+    while frontier:
+        for p in parents[frontier.pop()]:
+            if p not in z_anc:
+                z_anc.add(p)
+                frontier.append(p)
+
+    # up: the ball arrived from a child, down: it arrived from a parent
+    visited = set()
+    to_visit = [(x, True) for x in xs]
+    while to_visit:
+        node, up = to_visit.pop()
+        if (node, up) in visited:
+            continue
+        visited.add((node, up))
+        if node in ys and node not in zs:
+            return False
+        if up and node not in zs:
+            to_visit.extend((p, True) for p in parents[node])
+            to_visit.extend((c, False) for c in children[node])
+        elif not up:
+            if node not in zs:
+                to_visit.extend((c, False) for c in children[node])
+            if node in z_anc:
+                to_visit.extend((p, True) for p in parents[node])
+
+    return True
+
+
+def is_backdoor_set(adj_mat, c, e, ctrl_set, reach=None):
+    """
+    Check the backdoor criterion for the effect of c on e, controlling ctrl_set.
+
+    ctrl_set must not contain c, e or any descendant of c, and it must d-separate
+    c and e once the edges leaving c are removed.
+    """
+    if reach is None:
+        reach = GraphReach(adj_mat)
+    ctrl_set = set(ctrl_set)
+    if c in ctrl_set or e in ctrl_set or any(reach.desc[c, z] for z in ctrl_set):
+        return False
+    backdoor_adj_mat = reach.adj.copy()
+    backdoor_adj_mat[c, :] = False
+
+    return d_separated(backdoor_adj_mat, [c], [e], ctrl_set)
+
+
 def dag_gen(graph_shape, p, iter_n): # i.e. graph_shape = [4, 3, 5, 3, 4]
     node_n = np.sum(graph_shape)
     matrix = np.zeros((node_n, node_n))
@@ -78,3 +205,101 @@ def dag_gen(graph_shape, p, iter_n): # i.e. graph_shape = [4, 3, 5, 3, 4]
     complexity = [node_n, indegree_avg, chain_n, fork_n, collider_n]
 
     return node_list, node_tier, matrix, complexity
+
+
+def graph_complexity_count_batch(matrices):
+    # Same statistics as graph_complexity_count, for a stacked (graph, node, node) tensor
+    node_n = matrices.shape[1]
+    node_indegree = np.sum(matrices, axis=1, dtype=int)
+    node_outdegree = np.sum(matrices, axis=2, dtype=int)
+    indegree_avg = np.sum(node_indegree, axis=1) / node_n
+    chain_n = np.sum(node_indegree * node_outdegree, axis=1)
+    fork_n = np.sum(node_outdegree * (node_outdegree - 1) // 2, axis=1)
+    collider_n = np.sum(node_indegree * (node_indegree - 1) // 2, axis=1)
+
+    return [[node_n, float(indegree_avg[g]), int(chain_n[g]), int(fork_n[g]), int(collider_n[g])]
+            for g in range(matrices.shape[0])]
+
+
+def dag_gen_batch(graph_shape, p, iter_n, count, rng=None):
+    """
+    Generate `count` DAGs of the same shape at once.
+
+    Follows the same chain/fork/collider proposal scheme as dag_gen, but every
+    proposal of every graph is drawn up front from `rng` (a numpy Generator) and
+    scattered into a boolean adjacency tensor in one go.
+
+    Returns:
+        tuple: (node_list, node_tier, matrices, complexity) where matrices has shape
+        (count, node_n, node_n) and complexity holds one entry per graph.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    graph_shape = [int(s) for s in graph_shape]
+    node_n = int(np.sum(graph_shape))
+    tier_n = len(graph_shape)  # must bigger than 3
+    node_list = list(range(node_n))
+    node_tier = []
+    idx_tmp = 0
+    for i in graph_shape:
+        node_tier.append(node_list[idx_tmp:idx_tmp+i])
+        idx_tmp += i
+
+    tier_size = np.array(graph_shape)
+    tier_start = np.cumsum(tier_size) - tier_size
+    threshold = np.cumsum(np.asarray(p, dtype=float)[:3])
+
+    # One proposal per (graph, iteration, node)
+    shape = (count, iter_n, node_n)
+    t = np.broadcast_to(np.repeat(np.arange(tier_n), tier_size), shape)
+    node_i = np.broadcast_to(np.arange(node_n), shape)
+    node_state = rng.random(shape)
+    u = rng.random((4,) + shape)  # two tier draws, two node draws
+
+    is_chain = node_state < threshold[0]
+    is_fork = (threshold[0] <= node_state) & (node_state < threshold[1])
+    is_collider = (threshold[1] <= node_state) & (node_state < threshold[2])
+    first, last = t == 0, t == tier_n-1
+
+    # Chain from the first/last tier: two distinct tiers out of the other tier_n-1
+    a = (u[0] * (tier_n-1)).astype(int)
+    b = (u[1] * (tier_n-2)).astype(int)
+    b += b >= a
+    end_lo, end_hi = np.minimum(a, b), np.maximum(a, b)
+    end_lo = np.where(first, end_lo + 1, end_lo)
+    end_hi = np.where(first, end_hi + 1, end_hi)
+
+    # Tiers strictly below / above the node's own tier
+    below = [(u[k] * t).astype(int) for k in range(2)]
+    above = [t + 1 + (u[k] * (tier_n-1-t)).astype(int) for k in range(2)]
+
+    tier_lo = np.select(
+        [is_chain & (first | last), is_chain, is_fork],
+        [end_lo, below[0], np.minimum(above[0], above[1])],
+        np.minimum(below[0], below[1]))
+    tier_hi = np.select(
+        [is_chain & (first | last), is_chain, is_fork],
+        [end_hi, above[1], np.maximum(above[0], above[1])],
+        np.maximum(below[0], below[1]))
+    tier_lo = np.clip(tier_lo, 0, tier_n-1)
+    tier_hi = np.clip(tier_hi, 0, tier_n-1)
+    node_lo = tier_start[tier_lo] + (u[2] * tier_size[tier_lo]).astype(int)
+    node_hi = tier_start[tier_hi] + (u[3] * tier_size[tier_hi]).astype(int)
+
+    chain_first, chain_last = is_chain & first, is_chain & last
+    chain_mid = is_chain & ~first & ~last
+    src1 = np.select([chain_first, chain_last, chain_mid, is_fork], [node_i, node_lo, node_lo, node_i], node_lo)
+    dst1 = np.select([chain_first, chain_last, chain_mid, is_fork], [node_lo, node_hi, node_i, node_lo], node_i)
+    src2 = np.select([chain_first, chain_last, chain_mid, is_fork], [node_lo, node_hi, node_i, node_i], node_hi)
+    dst2 = np.select([chain_first, chain_last, chain_mid, is_fork], [node_hi, node_i, node_hi, node_hi], node_i)
+    valid = is_chain | (is_fork & ~last) | (is_collider & ~first)
+
+    graph_idx = np.broadcast_to(np.arange(count)[:, None, None], shape)[valid]
+    matrices = np.zeros((count, node_n, node_n), dtype=bool)
+    matrices[graph_idx, src1[valid], dst1[valid]] = True
+    matrices[graph_idx, src2[valid], dst2[valid]] = True
+
+    complexity = graph_complexity_count_batch(matrices)
+
+    return node_list, node_tier, matrices, complexity
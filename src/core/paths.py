@@ -44,6 +44,7 @@ NAME_DATA_DIR = os.path.join(DATA_DIR, 'name_data')
 PICKLE_DIR = os.path.join(GENERATED_DATA_DIR, 'pickle')
 GRAPH_PNG_DIR = os.path.join(GENERATED_DATA_DIR, 'graph_png')
 RESULT_DIR = os.path.join(GENERATED_DATA_DIR, 'result')
+CACHE_DIR = os.path.join(GENERATED_DATA_DIR, 'cache')
 
 # Model-specific result directories will be constructed with get_model_result_dirs()
 
@@ -61,13 +62,14 @@ def safe_join_path(*paths):
     """Join paths and normalize the result."""
     return normalize_path(os.path.join(*paths))
 
-def get_model_result_dirs(model_name):
+def get_model_result_dirs(model_name, resume=False):
     """
     Get the directory paths for test, answer extraction, and evaluation results
     for a specific model.
     
     If a directory for the given model already exists, a unique name will be created
-    by appending a number (e.g., model_name1, model_name2, etc.).
+    by appending a number (e.g., model_name1, model_name2, etc.). With resume=True
+    the most recent existing directory is reused instead.
     
     Returns:
         tuple: (model_dir, test_dir, ans_ex_dir, eval_dir)
@@ -75,14 +77,21 @@ def get_model_result_dirs(model_name):
     # Start with the original model name
     unique_model_name = model_name
     base_model_dir = safe_join_path(RESULT_DIR, model_name)
+    last_model_name = None
     
     # Check if the directory exists and find a unique name if needed
     counter = 1
     while os.path.exists(base_model_dir):
+        last_model_name = unique_model_name
         unique_model_name = f"{model_name}{counter}"
         base_model_dir = safe_join_path(RESULT_DIR, unique_model_name)
         counter += 1
     
+    if resume and last_model_name is not None:
+        unique_model_name = last_model_name
+        base_model_dir = safe_join_path(RESULT_DIR, unique_model_name)
+        print(f"Resuming results of model '{model_name}' in '{unique_model_name}'.", flush=True)
+    
     # Now use the unique model name to create the paths
     model_dir = base_model_dir
     test_dir = safe_join_path(model_dir, 'test')
@@ -90,7 +99,7 @@ def get_model_result_dirs(model_name):
     eval_dir = safe_join_path(model_dir, 'eval')
     
     # Log if we had to create a unique name
-    if unique_model_name != model_name:
+    if unique_model_name != model_name and not resume:
         print(f"Directory for model '{model_name}' already exists. Using '{unique_model_name}' instead.", flush=True)
     
     return model_dir, test_dir, ans_ex_dir, eval_dir
@@ -167,7 +176,7 @@ def get_available_models():
 
 def ensure_directories():
     """Ensure all required directories exist, creating them if necessary."""
-    base_dirs = [PICKLE_DIR, GRAPH_PNG_DIR, NAME_DATA_DIR, RESULT_DIR]
+    base_dirs = [PICKLE_DIR, GRAPH_PNG_DIR, NAME_DATA_DIR, RESULT_DIR, CACHE_DIR]
     
     # Create base directories
     for directory in base_dirs:
@@ -186,6 +195,7 @@ __all__ = [
     'PICKLE_DIR',
     'GRAPH_PNG_DIR',
     'RESULT_DIR',
+    'CACHE_DIR',
     'normalize_path',
     'file_exists',
     'dir_exists',
@@ -24,6 +24,10 @@ ensure_directories()
 DEFAULT_EXTRACTOR_MODEL = "gpt-4o"
 SECONDARY_EXTRACTOR_MODEL = "o3-mini"
 
+# Most concurrent API requests per model and key, unless a model sets "max_in_flight";
+# the adaptive window of src.api.concurrency grows up to it
+DEFAULT_MAX_IN_FLIGHT = int(os.environ.get('API_MAX_IN_FLIGHT', '16'))
+
 def get_test_settings(idx):
     # Get API keys directly from environment to ensure we have the most current values
     api_key = os.environ.get('OPENAI_API_KEY', '')
@@ -52,6 +56,7 @@ def get_test_settings(idx):
                 "test": True,
                 "ans_ex": True,
                 "eval": True,
+                "max_in_flight": DEFAULT_MAX_IN_FLIGHT,
             }
         },
         {
@@ -76,6 +81,7 @@ def get_test_settings(idx):
                 "test": True,
                 "ans_ex": True,
                 "eval": True,
+                "max_in_flight": DEFAULT_MAX_IN_FLIGHT,
             }
         },
         # Example configurations for other models
@@ -93,6 +99,7 @@ def get_test_settings(idx):
                 "test": True,
                 "ans_ex": True,
                 "eval": True,
+                "max_in_flight": DEFAULT_MAX_IN_FLIGHT,
             }
         },
         {
@@ -109,6 +116,7 @@ def get_test_settings(idx):
                 "test": True,
                 "ans_ex": True,
                 "eval": True,
+                "max_in_flight": DEFAULT_MAX_IN_FLIGHT,
             }
         },
         {
@@ -125,6 +133,7 @@ def get_test_settings(idx):
                 "test": True,
                 "ans_ex": True,
                 "eval": True,
+                "max_in_flight": DEFAULT_MAX_IN_FLIGHT,
             }
         }
     ]
@@ -143,6 +152,9 @@ def get_data_gen_settings(idx):
             "conf_ce_d": [1],
             "cf_whatif_n": [1, 2, 3],
             "name_type": ["bio", "che", "eco", "phy"],
+            "path_budget": 1000000,
+            "conf_noncausal_path": False,
+            "cf_whatif_select": "any",
         },
         {
             "gs_indicator": 1,
@@ -154,6 +166,9 @@ def get_data_gen_settings(idx):
             "conf_ce_d": [1, 0.5],
             "cf_whatif_n": [1, 2, 3],
             "name_type": ["bio", "che", "eco", "phy"],
+            "path_budget": 1000000,
+            "conf_noncausal_path": False,
+            "cf_whatif_select": "any",
         },
         {
             "gs_indicator": 2,
@@ -165,6 +180,9 @@ def get_data_gen_settings(idx):
             "conf_ce_d": [1, 0.5],
             "cf_whatif_n": [1, 2, 3],
             "name_type": ["bio", "che", "eco", "phy"],
+            "path_budget": 1000000,
+            "conf_noncausal_path": False,
+            "cf_whatif_select": "any",
         },
         {
             "gs_indicator": 3,
@@ -176,6 +194,9 @@ def get_data_gen_settings(idx):
             "conf_ce_d": [1, 0.75, 0.5],
             "cf_whatif_n": [1, 2, 3],
             "name_type": ["bio", "che", "eco", "phy"],
+            "path_budget": 1000000,
+            "conf_noncausal_path": False,
+            "cf_whatif_select": "any",
         },
     ]
     return settings[idx]
@@ -2,9 +2,14 @@
 """
 Script to generate test data for causal reasoning evaluations
 """
-import pickle
 import os
+import random
+import numpy as np
 import sys
+import argparse
+from multiprocessing import Pool
+from contextlib import nullcontext
+from itertools import chain
 from datetime import datetime
 from pathlib import Path
 
@@ -16,19 +21,149 @@ sys.path.insert(0, project_root)
 from src.utils.env_utils import load_env_variables
 load_env_variables()
 
-from src.utils.public_utils import int2two_char_str, draw_graph, node_name_gen_specific, node_name_gen
-from src.core.conf_utils import conf_qa_gen
-from src.core.cf_utils import cf_qa_gen
-from src.core.graph_utils import dag_gen
+from src.utils.public_utils import int2two_char_str, draw_graph, render_graphs, node_name_gen_specific, node_name_item
+from src.utils.store_utils import IndexedPickleWriter, AdjTensorWriter
+from src.core.conf_utils import conf_qa_gen_all
+from src.core.cf_utils import cf_qa_gen_all
+from src.core.graph_utils import dag_gen_batch, pack_adj_mat, get_adj_mat, GraphReach
 from src.core.settings import get_data_gen_settings, GENERATED_DATA_DIR, PICKLE_DIR, GRAPH_PNG_DIR
 
+# Attempts to draw a graph within the path budget before giving up on a gid
+MAX_REGEN = 100
+# Gids of a condition whose graphs are drawn by one dag_gen_batch call. The chunks
+# do not depend on the worker count, so neither do the generated graphs.
+GEN_CHUNK = 32
+
+
+def gid_seed(seed_seq):
+    """
+    Seed all random state used to generate one gid.
+
+    Args:
+        seed_seq (numpy.random.SeedSequence): Seed of the gid, spawned from the seed of its chunk
+
+    Returns:
+        numpy.random.Generator: Generator for the vectorized draws of this gid
+    """
+    legacy_seed = seed_seq.generate_state(2)
+    random.seed(int(legacy_seed[0]))
+    np.random.seed(legacy_seed[1])
+    return np.random.default_rng(seed_seq)
+
+
+def gen_graph_chunk(task):
+    """
+    Generate the graphs, node names and queries of a chunk of gids of one condition.
+
+    The first graph of every gid is drawn by one dag_gen_batch call from the seed of
+    the chunk. Every gid then gets a child seed, from which its redrawn graphs (if it
+    is over the path budget) and everything else about it are generated.
+
+    Args:
+        task (tuple): (seed_seq, gids, graph_shape, graph_p, path_iter_n, options), where options
+            holds conf_ce_d, cf_whatif_n, name_type, path_budget, conf_noncausal_path, cf_whatif_select
+            and the render mode
+
+    Returns:
+        list: (graph_item, name_item, conf_query_items, cf_query_items) of every gid, in gid order
+    """
+    seed_seq, gids, g_s, g_p, p_itn, options = task
+    node_list, node_tier, matrices, complexities = dag_gen_batch(
+        g_s, g_p, p_itn, len(gids), np.random.default_rng(seed_seq)
+    )
+    return [
+        gen_graph_data(gid, gid_seed(gid_seq), node_list, node_tier, matrix, complexity, (g_s, g_p, p_itn), options)
+        for gid, gid_seq, matrix, complexity in zip(gids, seed_seq.spawn(len(gids)), matrices, complexities)
+    ]
+
+
+def gen_graph_data(gid, rng, node_list, node_tier, matrix, complexity, condition, options):
+    """
+    Generate the node names and queries of one gid from its first drawn graph.
+
+    Args:
+        rng (numpy.random.Generator): Generator of this gid, see gid_seed
+        condition (tuple): (graph_shape, graph_p, path_iter_n) to redraw the graph with
+
+    Returns:
+        tuple: (graph_item, name_item, conf_query_items, cf_query_items)
+    """
+    conf_ce_d = options["conf_ce_d"]
+    cf_whatif_n = options["cf_whatif_n"]
+    name_type = options["name_type"]
+    path_budget = options["path_budget"]
+    noncausal_path = options["conf_noncausal_path"]
+
+    # Graphs with more paths than the budget, over all their conf queries, are redrawn.
+    # The paths of the queries are enumerated once, by the budget check.
+    for attempt in range(MAX_REGEN):
+        if attempt:
+            # Only this gid is redrawn, from its own seed
+            _, _, matrices, complexities = dag_gen_batch(*condition, 1, rng)
+            matrix = matrices[0]
+            complexity = complexities[0]
+        # Reachability is analysed once and shared by every query of this graph
+        reach = GraphReach(matrix)
+        conf_qa_list = conf_qa_gen_all(node_tier, matrix, conf_ce_d, reach, noncausal_path, path_budget)
+        if conf_qa_list is not None:
+            break
+    else:
+        raise RuntimeError(f"No graph within path_budget={path_budget} after {MAX_REGEN} attempts for gid {gid}")
+
+    if options["render"] == "inline":
+        draw_graph(
+            matrix, node_list, os.path.join(GRAPH_PNG_DIR, gid)
+        )
+    graph_item = {
+        "gid": gid,
+        "mat_bits": pack_adj_mat(matrix),
+        "node_tier": node_tier,
+        "node_n": complexity[0],
+        "in_degree_avg": complexity[1],
+        "chain_n": complexity[2],
+        "fork_n": complexity[3],
+        "collider_n": complexity[4],
+    }
+
+    node_name_s = node_name_gen_specific(node_list, rng)
+    name_item = node_name_item(gid, node_name_s, name_type, rng)
+
+    conf_query_items = []
+    for ce_d, conf_qa_d in zip(conf_ce_d, conf_qa_list):
+        if ce_d == 1:
+            ce_d_id = "100"
+        else:
+            ce_d_id = "0" + int2two_char_str(int(ce_d * 100))
+        conf_item_id = gid + ce_d_id  # 8 digit gid + 3 digit ce_d_id
+        id_d = {"conf_id": conf_item_id}
+        conf_query_items.append({**id_d, **conf_qa_d})
+
+    # All whatif_n queries of a graph are picked from one intervention table
+    cf_query_items = []
+    cf_qa_list = cf_qa_gen_all(node_tier, matrix, cf_whatif_n, reach, options["cf_whatif_select"])
+    for wi_n, cf_qa_d in zip(cf_whatif_n, cf_qa_list):
+        cf_item_id = gid + int2two_char_str(
+            wi_n
+        )  # 8 digit gid + 2 digit wi_n
+        id_d = {"cf_id": cf_item_id}
+        cf_query_items.append({**id_d, **cf_qa_d})
+
+    return graph_item, name_item, conf_query_items, cf_query_items
+
+
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python -m src.entrypoints.run_data_gen <settings_index>")
-        sys.exit(1)
-    
-    settings_index = int(sys.argv[1])
-    
+    parser = argparse.ArgumentParser(description="Generate test data for causal reasoning evaluations")
+    parser.add_argument('settings_index', type=int,
+                        help='Index of settings to use from settings.py')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes generating graphs in parallel')
+    parser.add_argument('--render', choices=['none', 'deferred', 'inline'], default='deferred',
+                        help='Graph PNG rendering: skip it, render in batches once the data is written, '
+                             'or render every graph during generation')
+    args = parser.parse_args()
+
+    settings_index = args.settings_index
+
     (
         gs_indicator,
         graph_shape,
@@ -39,6 +174,9 @@ def main():
         conf_ce_d,
         cf_whatif_n,
         name_type,
+        path_budget,
+        conf_noncausal_path,
+        cf_whatif_select,
     ) = get_data_gen_settings(settings_index).values()
 
     # Ensure output directories exist
@@ -47,95 +185,77 @@ def main():
 
     if not os.path.exists(PICKLE_DIR):
         os.makedirs(PICKLE_DIR)
-    
+
     graph_n = len(graph_shape) * len(graph_p) * len(path_iter_n) * graph_n_per_condition
     graph_count = 0
-    
+
     pickle_out_path = {
         "graph": os.path.join(PICKLE_DIR, f"graph_data_{graph_shape_group}.pkl"),
         "node_name": os.path.join(PICKLE_DIR, f"node_name_data_{graph_shape_group}.pkl"),
         "conf": os.path.join(PICKLE_DIR, f"conf_query_data_{graph_shape_group}.pkl"),
         "cf": os.path.join(PICKLE_DIR, f"cf_query_data_{graph_shape_group}.pkl"),
     }
-    
-    fp_out_graph = open(pickle_out_path["graph"], "wb")
-    fp_out_name = open(pickle_out_path["node_name"], "wb")
-    fp_out_conf = open(pickle_out_path["conf"], "wb")
-    fp_out_cf = open(pickle_out_path["cf"], "wb")
 
+    options = {
+        "conf_ce_d": conf_ce_d,
+        "cf_whatif_n": cf_whatif_n,
+        "name_type": name_type,
+        "path_budget": path_budget,
+        "conf_noncausal_path": conf_noncausal_path,
+        "cf_whatif_select": cf_whatif_select,
+        "render": args.render,
+    }
+    # Every condition has its own seed, split into one seed per chunk of its gids
+    tasks = []
     for g_s in graph_shape:
         for g_p in graph_p:
             for p_itn in path_iter_n:
-                for g_n in range(graph_n_per_condition):
-                    print(
-                        datetime.now(), f"Process [{graph_count}/{graph_n-1}]", flush=True
-                    )
-                    graph_count += 1
-
-                    # gid is 8 digits
-                    gid = f"{gs_indicator}{graph_shape.index(g_s)}{int2two_char_str(graph_p.index(g_p))}{int2two_char_str(path_iter_n.index(p_itn))}{int2two_char_str(g_n)}"
-                    node_list, node_tier, matrix, complexity = dag_gen(
-                        g_s, g_p, p_itn
-                    )
-                    draw_graph(
-                        matrix, node_list, os.path.join(GRAPH_PNG_DIR, gid)
-                    )
-                    graph_item = {
-                        "gid": gid,
-                        "mat": matrix,
-                        "node_tier": node_tier,
-                        "node_n": complexity[0],
-                        "in_degree_avg": complexity[1],
-                        "chain_n": complexity[2],
-                        "fork_n": complexity[3],
-                        "collider_n": complexity[4],
-                    }
-                    pickle.dump(graph_item, fp_out_graph)
-
-                    node_name_s = node_name_gen_specific(node_list)
-                    node_name = []
-                    for n_t in name_type:
-                        n, n_c = node_name_gen(node_name_s, n_t)
-                        node_name.append([n, n_c])
-                    name_item = {
-                        "gid": gid,
-                        "specific": node_name_s,
-                        "bio": node_name[0][0],
-                        "bio_c": node_name[0][1],
-                        "che": node_name[1][0],
-                        "che_c": node_name[1][1],
-                        "eco": node_name[2][0],
-                        "eco_c": node_name[2][1],
-                        "phy": node_name[3][0],
-                        "phy_c": node_name[3][1],
-                    }
-                    pickle.dump(name_item, fp_out_name)
-
-                    for ce_d in conf_ce_d:
-                        if ce_d == 1:
-                            ce_d_id = "100"
-                        else:
-                            ce_d_id = "0" + int2two_char_str(int(ce_d * 100))
-                        conf_item_id = gid + ce_d_id  # 8 digit gid + 3 digit ce_d_id
-                        conf_qa_d = conf_qa_gen(node_tier, matrix, ce_d)
-                        id_d = {"conf_id": conf_item_id}
-                        conf_query_item = {**id_d, **conf_qa_d}
-                        pickle.dump(conf_query_item, fp_out_conf)
-
-                    for wi_n in cf_whatif_n:
-                        cf_item_id = gid + int2two_char_str(
-                            wi_n
-                        )  # 8 digit gid + 2 digit wi_n
-                        id_d = {"cf_id": cf_item_id}
-                        cf_qa_d = cf_qa_gen(node_tier, matrix, wi_n)
-                        cf_query_item = {**id_d, **cf_qa_d}
-                        pickle.dump(cf_query_item, fp_out_cf)
-
-    fp_out_graph.close()
-    fp_out_name.close()
-    fp_out_conf.close()
-    fp_out_cf.close()
+                condition_idx = [graph_shape.index(g_s), graph_p.index(g_p), path_iter_n.index(p_itn)]
+                # gid is 8 digits
+                gids = [
+                    f"{gs_indicator}{condition_idx[0]}{int2two_char_str(condition_idx[1])}{int2two_char_str(condition_idx[2])}{int2two_char_str(g_n)}"
+                    for g_n in range(graph_n_per_condition)
+                ]
+                chunk_starts = range(0, graph_n_per_condition, GEN_CHUNK)
+                chunk_seqs = np.random.SeedSequence([settings_index] + condition_idx).spawn(len(chunk_starts))
+                for start, chunk_seq in zip(chunk_starts, chunk_seqs):
+                    tasks.append((chunk_seq, gids[start:start + GEN_CHUNK], g_s, g_p, p_itn, options))
+
+    # Each pickle gets a sidecar offset index for random access by gid / query id.
+    # All adjacency matrices of the group also go into one memory-mappable tensor.
+    # The writers and the pool are closed even if a gid fails, so the files written so far keep their indexes.
+    # The tensor writer is entered first so it closes last, after the graph pickle it describes.
+    render_queue = []
+    with AdjTensorWriter(pickle_out_path["graph"], graph_n, max(int(sum(g_s)) for g_s in graph_shape)) as adj_writer, \
+            IndexedPickleWriter(pickle_out_path["graph"]) as fp_out_graph, \
+            IndexedPickleWriter(pickle_out_path["node_name"]) as fp_out_name, \
+            IndexedPickleWriter(pickle_out_path["conf"]) as fp_out_conf, \
+            IndexedPickleWriter(pickle_out_path["cf"]) as fp_out_cf, \
+            (Pool(args.workers) if args.workers > 1 else nullcontext()) as pool:
+        # Results come back in gid order, so the pickles do not depend on the worker count
+        results = pool.imap(gen_graph_chunk, tasks) if pool else map(gen_graph_chunk, tasks)
+        for graph_item, name_item, conf_query_items, cf_query_items in chain.from_iterable(results):
+            print(
+                datetime.now(), f"Process [{graph_count}/{graph_n-1}]", flush=True
+            )
+            graph_count += 1
+
+            fp_out_graph.dump(graph_item)
+            adj_mat = get_adj_mat(graph_item)
+            adj_writer.add(graph_item["gid"], adj_mat)
+            if args.render == "deferred":
+                gid = graph_item["gid"]
+                render_queue.append((adj_mat, list(range(graph_item["node_n"])), os.path.join(GRAPH_PNG_DIR, gid)))
+            fp_out_name.dump(name_item)
+            for conf_query_item in conf_query_items:
+                fp_out_conf.dump(conf_query_item)
+            for cf_query_item in cf_query_items:
+                fp_out_cf.dump(cf_query_item)
+
+    if render_queue:
+        print(datetime.now(), f"Data written, rendering {len(render_queue)} graphs...", flush=True)
+        render_graphs(render_queue, workers=args.workers)
     print(datetime.now(), "All finished.", flush=True)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
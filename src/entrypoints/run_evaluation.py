@@ -14,7 +14,9 @@ sys.path.insert(0, project_root)
 
 from src.tests.test_utils import test_llm
 from src.evaluation.eval_utils import extract_answer, eval_llm
-from src.core.settings import get_test_settings, DEFAULT_EXTRACTOR_MODEL
+from src.core.dataset_session import DatasetSession
+from src.api.rate_limiter import get_rate_limiter, merge_limit
+from src.core.settings import get_test_settings, DEFAULT_EXTRACTOR_MODEL, DEFAULT_MAX_IN_FLIGHT
 from src.core.paths import (
     GENERATED_DATA_DIR, 
     PICKLE_DIR, 
@@ -27,10 +29,11 @@ from src.core.paths import (
 
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python -m src.entrypoints.run_evaluation <settings_index>")
+        print("Usage: python -m src.entrypoints.run_evaluation <settings_index> [--resume]")
         sys.exit(1)
     
     settings_index = int(sys.argv[1])
+    resume_all = "--resume" in sys.argv[2:]
     
     data_folder = PICKLE_DIR
     settings = get_test_settings(settings_index)
@@ -43,9 +46,30 @@ def main():
             extractor_model = settings[model].get('extractor_model', DEFAULT_EXTRACTOR_MODEL)
             graph_shape_group = settings[model]['graph_shape_group']
             graph_shape = settings[model]['graph_shape']
+            max_in_flight = settings[model].get('max_in_flight', DEFAULT_MAX_IN_FLIGHT)
+            extractor_max_in_flight = settings[model].get('extractor_max_in_flight', max_in_flight)
+            # True to reuse cached responses, "refresh" to resend and overwrite them, False to bypass the cache
+            cache = settings[model].get('cache', True)
+            # Continue the latest result directory, keeping the responses and answers it already holds
+            resume = resume_all or settings[model].get('resume', False)
+            # Latency percentile after which slow requests are sent again, None to disable hedging
+            hedge = settings[model].get('hedge')
+            # Optional per-minute request / token limits of the tested and extractor models,
+            # merged when both use the same model and key
+            rate_limits = {}
+            for limit_model, limit_key, rpm, tpm in [(model, test_api_key, settings[model].get('rpm'), settings[model].get('tpm')),
+                                                     (extractor_model, extractor_api_key, settings[model].get('extractor_rpm'), settings[model].get('extractor_tpm'))]:
+                if limit_key:
+                    merged_rpm, merged_tpm = rate_limits.get((limit_model, limit_key), (None, None))
+                    rate_limits[(limit_model, limit_key)] = (merge_limit(merged_rpm, rpm), merge_limit(merged_tpm, tpm))
+            for (limit_model, limit_key), (rpm, tpm) in rate_limits.items():
+                get_rate_limiter(limit_model, limit_key, rpm, tpm)
             
+            # Graph, name and query data are loaded once and shared by every task, name type and prompt
+            session = DatasetSession(data_folder, graph_shape_group)
+
             # Get model-specific result directories
-            model_dir, test_dir, ans_ex_dir, eval_dir = get_model_result_dirs(model)
+            model_dir, test_dir, ans_ex_dir, eval_dir = get_model_result_dirs(model, resume)
             
             # Create directories if they don't exist
             for directory in [test_dir, ans_ex_dir, eval_dir]:
@@ -65,7 +89,7 @@ def main():
                         # Check if test file exists before proceeding
                         if settings[model]['test']:
                             print(datetime.now(), "start test...", flush=True)
-                            test_llm(test_api_key, model, t, graph_shape_group, graph_shape, n, p, data_folder, test_file)
+                            test_llm(test_api_key, model, t, graph_shape_group, graph_shape, n, p, data_folder, test_file, session, max_in_flight, cache, resume, hedge)
                             print(datetime.now(), "test done", flush=True)
                         elif not file_exists(test_file):
                             print(f"WARNING: Test file does not exist: {test_file}")
@@ -78,7 +102,7 @@ def main():
                             try:
                                 # Wait for test file to be fully written
                                 if wait_for_file(test_file):
-                                    extract_answer(extractor_api_key, extractor_model, t, test_file, ans_ex_file)
+                                    extract_answer(extractor_api_key, extractor_model, t, test_file, ans_ex_file, extractor_max_in_flight, cache, resume, hedge)
                                     print(datetime.now(), "answer extraction done", flush=True)
                                 else:
                                     print(f"ERROR: Test file not available after waiting: {test_file}")
@@ -99,7 +123,7 @@ def main():
                             try:
                                 # Wait for ans_ex file to be fully written
                                 if wait_for_file(ans_ex_file):
-                                    eval_llm(t, graph_shape_group, n, data_folder, ans_ex_file, eval_file)
+                                    eval_llm(t, graph_shape_group, n, data_folder, ans_ex_file, eval_file, session)
                                     print(datetime.now(), "evaluation done", flush=True)
                                 else:
                                     print(f"ERROR: Answer extraction file not available after waiting: {ans_ex_file}")
@@ -29,6 +29,10 @@ def main():
                         help='Index of settings to use from settings.py')
     parser.add_argument('--verbose', '-v', action='store_true', 
                         help='Enable verbose output')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes for data generation')
+    parser.add_argument('--render', choices=['none', 'deferred', 'inline'], default='deferred',
+                        help='Graph PNG rendering mode for data generation')
     
     args = parser.parse_args()
     
@@ -38,7 +42,7 @@ def main():
         print(f"Generating test data with settings index {args.settings_index}...")
         # Import data generation function lazily to avoid circular imports
         orig_argv = sys.argv.copy()
-        sys.argv = ['run_data_gen.py', str(args.settings_index)]
+        sys.argv = ['run_data_gen.py', str(args.settings_index), '--workers', str(args.workers), '--render', args.render]
         
         # Use lazy import to avoid circular dependency
         from src.entrypoints.run_data_gen import main as data_gen_main
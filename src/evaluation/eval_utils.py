@@ -1,11 +1,14 @@
 import json
-import time
 import sys
-import pickle
 from datetime import datetime
-from src.api.api_request_utils import get_response
-from src.core.settings import DEFAULT_EXTRACTOR_MODEL
-from src.core.paths import normalize_path, safe_join_path, wait_for_file
+from src.api.request_engine import RequestEngine, NETWORK_ERROR
+from src.core.settings import DEFAULT_EXTRACTOR_MODEL, DEFAULT_MAX_IN_FLIGHT
+from src.core.paths import normalize_path, wait_for_file
+from src.core.graph_utils import GraphReach, is_backdoor_set
+from src.core.dataset_session import DatasetSession, get_query_name_type
+from src.utils.public_utils import PathSet
+from src.utils.jsonl_utils import resume_jsonl
+import numpy as np
 import os
 
 
@@ -39,7 +42,7 @@ If you can't extract, please output "Unknown". Do not output other redundant con
     return extract_prompt
 
 
-def extract_answer(api_key, model=None, query_type=None, input_json_path=None, output_json_path=None):
+def extract_answer(api_key, model=None, query_type=None, input_json_path=None, output_json_path=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT, cache=True, resume=False, hedge=None):
     # Default to DEFAULT_EXTRACTOR_MODEL if model is not provided
     if model is None:
         model = DEFAULT_EXTRACTOR_MODEL
@@ -56,73 +59,46 @@ def extract_answer(api_key, model=None, query_type=None, input_json_path=None, o
     with open(input_json_path, 'r', encoding='utf-8') as f_in:
         lines = f_in.readlines()
     
-    f_out = open(output_json_path, 'w', encoding='utf-8')
-    retry_threshold = 3
-    global_retry_threshold = retry_threshold * 20
-    global_retried_cnt = 0
-    current_cnt = 0
-    
-    for l in lines:
-        res_dict = json.loads(l)
-        print(datetime.now(), f"Extracting at {current_cnt} | {res_dict['query_id']}", flush=True)
-        current_cnt += 1
-        
-        # Add delay between API calls to avoid rate limiting
-        time.sleep(2)
-        
-        retry_cnt = 0
-        backoff_time = 10
-        extracted_text = "[Network Error]"
-        if res_dict['response_text'] != "[Network Error]":
-            input_text = get_extract_prompt(query_type) + "\n\n" + res_dict['query_text'] + "\nAnswer:\n" + res_dict['response_text']
-            while retry_cnt < retry_threshold:
-                try:
-                    # Add debugging info
-                    print(f"Making API call with key: {api_key[:5]}...{api_key[-5:] if api_key else 'None'}")
-                    print(f"Using model: {model}")
-                    response = get_response(api_key, model, input_text)
-                    extracted_text = response['choices'][0]['message']['content']
-                    global_retried_cnt = 0
-                    break
-                except Exception as e:
-                    print(f"API Error: {str(e)}")
-                    time.sleep(backoff_time)
-                    backoff_time *= 1.5
-                    retry_cnt += 1
-                    global_retried_cnt += 1
-        
+    # When resuming, answers extracted in an earlier run are kept and only the others are extracted
+    done_ids = resume_jsonl(output_json_path, "extracted_answer", NETWORK_ERROR) if resume else set()
+    f_out = open(output_json_path, 'a' if resume else 'w', encoding='utf-8')
+    print(f"Extracting with key: {api_key[:5]}...{api_key[-5:] if api_key else 'None'}")
+    print(f"Using model: {model}")
+
+    def jobs():
+        for current_cnt, l in enumerate(lines):
+            res_dict = json.loads(l)
+            if res_dict['query_id'] in done_ids:
+                continue
+            print(datetime.now(), f"Extracting at {current_cnt} | {res_dict['query_id']}", flush=True)
+            # Failed test responses are not sent to the extractor
+            input_text = None
+            if res_dict['response_text'] != NETWORK_ERROR:
+                input_text = get_extract_prompt(query_type) + "\n\n" + res_dict['query_text'] + "\nAnswer:\n" + res_dict['response_text']
+            yield input_text, res_dict
+
+    def write_answer(res_dict, extracted_text):
         print(f"======={res_dict['query_id']}=======", flush=True)
         print(f"extracted answer:\n {extracted_text}\n", flush=True)
         res_dict['extracted_answer'] = extracted_text
         f_out.write(json.dumps(res_dict, ensure_ascii=False) + '\n')
         f_out.flush()
-        if global_retried_cnt >= global_retry_threshold:
-            f_out.close()
-            sys.exit("Failed to connect to llm api after many retries.")
-    
-    f_out.close()        
+
+    # Answers are extracted concurrently and written in the order of the test file
+    engine = RequestEngine(api_key, model, max_in_flight, cache=cache, hedge=hedge)
+    finished = engine.run(jobs(), write_answer)
+    f_out.close()
+    if not finished:
+        sys.exit("Failed to connect to llm api after many retries.")
     print(datetime.now(), "Answer extraction done.", flush=True)
 
 
-def validate_conf_ctrl(name_list, adj_mat, c2e_noncausal_path, extracted_answer):
-    def validate_ctrl_set(ctrl_set_idx, c2e_noncausal_path):
-        for path_ce_pair in c2e_noncausal_path:
-            for p in path_ce_pair:
-                path_ctrl_state = False
-                for n_idx in range(1, len(p) - 1):
-                    node_indegree = adj_mat[p[n_idx - 1]][p[n_idx]] + adj_mat[p[n_idx + 1]][p[n_idx]]
-                    if node_indegree == 2:
-                        if n_idx not in ctrl_set_idx:
-                            path_ctrl_state = True
-                            break
-                    else:
-                        if n_idx in ctrl_set_idx:
-                            path_ctrl_state = True
-                            break
-                if path_ctrl_state == False:
-                    return False
-        return True
-    
+def validate_conf_ctrl(name_list, adj_mat, c_list, e_list, extracted_answer, reach=None):
+    # The answer must satisfy the backdoor criterion for every cause/effect pair,
+    # checked by d-separation on the graph itself rather than on enumerated paths
+    if reach is None:
+        reach = GraphReach(adj_mat)
+
     ctrl_set_idx = []
     try:
         ctrl_set_str = [s.strip().lower() for s in extracted_answer.split(',')]
@@ -130,7 +106,7 @@ def validate_conf_ctrl(name_list, adj_mat, c2e_noncausal_path, extracted_answer)
     except Exception as e:
         print(f"Error: {e}", flush=True)
         pass
-    ctrl_state = validate_ctrl_set(ctrl_set_idx, c2e_noncausal_path)
+    ctrl_state = all(is_backdoor_set(reach.adj, c, e, ctrl_set_idx, reach) for c in c_list for e in e_list)
 
     return ctrl_state
 
@@ -144,12 +120,12 @@ def validate_ce_path(name_list, c2e_path, extracted_answer):
         except Exception as e:
             print(f"Error: {e}", flush=True)
             pass
-    
-    c2e_path_flat = []
-    for i in c2e_path:
-        for p in i:
-            c2e_path_flat.append(p)
-    if sorted(ans_path_flat) == sorted(c2e_path_flat):
+
+    if not isinstance(c2e_path, PathSet):
+        c2e_path = PathSet.from_paths(c2e_path)
+    # Compare the answer and the ground truth as multisets of int16 node sequences
+    ans_path_keys = [np.array(p, dtype=np.int16).tobytes() for p in ans_path_flat]
+    if sorted(ans_path_keys) == sorted(c2e_path.path_keys()):
         result = True
     else:
         result = False
@@ -195,71 +171,42 @@ def validate_cf_tasks(name_list, query_idx, gt_assign, extracted_answer):
     return result
 
 
-def eval_llm(query_type, graph_shape_group, name_type, data_folder, ans_ex_path, output_path):
+def eval_llm(query_type, graph_shape_group, name_type, data_folder, ans_ex_path, output_path, session=None):
     # Normalize paths
     data_folder = normalize_path(data_folder)
     ans_ex_path = normalize_path(ans_ex_path)
     output_path = normalize_path(output_path)
     
-    # Construct paths using safe_join_path
-    f_qd_path = safe_join_path(data_folder, f"{query_type.split('_')[0]}_query_data_{graph_shape_group}.pkl")
-    f_nd_path = safe_join_path(data_folder, f"node_name_data_{graph_shape_group}.pkl")
-    f_gd_path = safe_join_path(data_folder, f"graph_data_{graph_shape_group}.pkl")
-    
     # Wait for the answer extraction file to exist
     if not wait_for_file(ans_ex_path):
         raise FileNotFoundError(f"Answer extraction file not available after multiple retries: {ans_ex_path}")
     
-    # Open necessary files
-    f_qd = open(f_qd_path, 'rb')
-    f_nd = open(f_nd_path, 'rb')
-    f_gd = open(f_gd_path, 'rb')
+    # Queries are looked up by id in the session, so the answer file may be sampled or reordered
+    if session is None:
+        session = DatasetSession(data_folder, graph_shape_group)
+    query_data = session.query_data(query_type.split('_')[0])
     f_out = open(output_path, 'w', encoding='utf-8')
 
     test_counter = 0
-    current_gid = ""
-    graph_dict = {}
-    name_dict = {}
-
-    if query_type[0:2] == "cf":
-        if name_type != "specific":
-            name_type = name_type + "_c"
+    name_type = get_query_name_type(query_type, name_type)
 
     with open(ans_ex_path, 'r', encoding='utf-8') as f_in:
         lines = f_in.readlines()
     
-    if query_type[:4] == "conf":
-        id_entry = "conf_id"
-    else:
-        id_entry = "cf_id"
-
     for l in lines:
         qa_dict = json.loads(l)
         qa_item_id = qa_dict['query_id']
         test_counter += 1
         required_gid = qa_item_id[:8]
-        current_qid = ""
-        while current_qid != qa_item_id:
-            try:
-                query_dict = pickle.load(f_qd)
-                current_qid = query_dict[id_entry]
-            except EOFError:
-                print("Query data incompatible.", flush=True)
-                sys.exit("Query data incompatible.")
+        if qa_item_id not in query_data:
+            print("Query data incompatible.", flush=True)
+            sys.exit("Query data incompatible.")
+        query_dict = query_data[qa_item_id]
 
-        if current_gid != required_gid:
-            while True:
-                try:
-                    graph_dict = pickle.load(f_gd)
-                    name_dict = pickle.load(f_nd)
-                    read_g_gid = graph_dict['gid']
-                    read_n_gid = name_dict['gid']
-                    if read_g_gid == read_n_gid and read_g_gid == required_gid:
-                        current_gid = read_g_gid
-                        break
-                except EOFError:
-                    print("Graph/Name data incompatible.", flush=True)
-                    sys.exit("Graph/Name data incompatible.")
+        if not session.has_graph(required_gid):
+            print("Graph/Name data incompatible.", flush=True)
+            sys.exit("Graph/Name data incompatible.")
+        name_list = session.node_names(required_gid, name_type)
 
         print(datetime.now(), f"evaluation process at {test_counter} | {qa_item_id}", flush=True)
 
@@ -270,16 +217,16 @@ def eval_llm(query_type, graph_shape_group, name_type, data_folder, ans_ex_path,
         else:
             match query_type:
                 case "conf_ce_path":
-                    result = validate_ce_path(name_dict[name_type], query_dict['c2e_path'], qa_dict['extracted_answer'])
+                    result = validate_ce_path(name_list, query_dict['c2e_path'], qa_dict['extracted_answer'])
                 
                 case "conf_conf_ctrl":
-                    result = validate_conf_ctrl(name_dict[name_type], graph_dict['mat'], query_dict['c2e_noncausal_path'], qa_dict['extracted_answer'])
+                    result = validate_conf_ctrl(name_list, session.adj_mat(required_gid), query_dict['c_list'], query_dict['e_list'], qa_dict['extracted_answer'], session.reach(required_gid))
                 
                 case "cf_f_infer":
-                    result = validate_cf_tasks(name_dict[name_type], query_dict['cf_query'], query_dict['f_assign'], qa_dict['extracted_answer'])
+                    result = validate_cf_tasks(name_list, query_dict['cf_query'], query_dict['f_assign'], qa_dict['extracted_answer'])
                 
                 case "cf_cf_infer":
-                    result = validate_cf_tasks(name_dict[name_type], query_dict['cf_query'], query_dict['cf_assign'], qa_dict['extracted_answer'])
+                    result = validate_cf_tasks(name_list, query_dict['cf_query'], query_dict['cf_assign'], qa_dict['extracted_answer'])
 
         print(f"======={qa_item_id}=======", flush=True)
         print(f"eval result:\n {result}\n", flush=True)
@@ -11,10 +11,10 @@ from datetime import datetime
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 sys.path.insert(0, project_root)
 
-from src.utils.public_utils import int2two_char_str, draw_graph, node_name_gen_specific, node_name_gen
+from src.utils.public_utils import int2two_char_str, draw_graph, node_name_gen_specific, node_name_item
 from src.core.conf_utils import conf_qa_gen
 from src.core.cf_utils import cf_qa_gen
-from src.core.graph_utils import dag_gen
+from src.core.graph_utils import dag_gen, pack_adj_mat
 from src.core.settings import get_data_gen_settings
 from src.core.paths import GENERATED_DATA_DIR, PICKLE_DIR, GRAPH_PNG_DIR
 
@@ -36,6 +36,9 @@ def main():
         conf_ce_d,
         cf_whatif_n,
         name_type,
+        path_budget,
+        conf_noncausal_path,
+        cf_whatif_select,
     ) = get_data_gen_settings(settings_index).values()
 
     # Ensure output directories exist
@@ -76,7 +79,7 @@ def main():
                     )
                     graph_item = {
                         "gid": gid,
-                        "mat": matrix,
+                        "mat_bits": pack_adj_mat(matrix),
                         "node_tier": node_tier,
                         "node_n": complexity[0],
                         "in_degree_avg": complexity[1],
@@ -87,22 +90,7 @@ def main():
                     pickle.dump(graph_item, fp_out_graph)
 
                     node_name_s = node_name_gen_specific(node_list)
-                    node_name = []
-                    for n_t in name_type:
-                        n, n_c = node_name_gen(node_name_s, n_t)
-                        node_name.append([n, n_c])
-                    name_item = {
-                        "gid": gid,
-                        "specific": node_name_s,
-                        "bio": node_name[0][0],
-                        "bio_c": node_name[0][1],
-                        "che": node_name[1][0],
-                        "che_c": node_name[1][1],
-                        "eco": node_name[2][0],
-                        "eco_c": node_name[2][1],
-                        "phy": node_name[3][0],
-                        "phy_c": node_name[3][1],
-                    }
+                    name_item = node_name_item(gid, node_name_s, name_type)
                     pickle.dump(name_item, fp_out_name)
 
                     for ce_d in conf_ce_d:
@@ -111,7 +99,7 @@ def main():
                         else:
                             ce_d_id = "0" + int2two_char_str(int(ce_d * 100))
                         conf_item_id = gid + ce_d_id  # 8 digit gid + 3 digit ce_d_id
-                        conf_qa_d = conf_qa_gen(node_tier, matrix, ce_d)
+                        conf_qa_d = conf_qa_gen(node_tier, matrix, ce_d, noncausal_path=conf_noncausal_path)
                         id_d = {"conf_id": conf_item_id}
                         conf_query_item = {**id_d, **conf_qa_d}
                         pickle.dump(conf_query_item, fp_out_conf)
@@ -121,7 +109,7 @@ def main():
                             wi_n
                         )  # 8 digit gid + 2 digit wi_n
                         id_d = {"cf_id": cf_item_id}
-                        cf_qa_d = cf_qa_gen(node_tier, matrix, wi_n)
+                        cf_qa_d = cf_qa_gen(node_tier, matrix, wi_n, select=cf_whatif_select)
                         cf_query_item = {**id_d, **cf_qa_d}
                         pickle.dump(cf_query_item, fp_out_cf)
 
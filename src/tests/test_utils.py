@@ -1,6 +1,4 @@
-import pickle
 import json
-import time
 import sys
 import os
 from datetime import datetime
@@ -9,11 +7,11 @@ from datetime import datetime
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 sys.path.insert(0, project_root)
 
-from src.core.conf_utils import dict2text as conf_d2t
-from src.core.cf_utils import dict2text as cf_d2t
-from src.api.api_request_utils import get_response
-from src.core.settings import DEFAULT_EXTRACTOR_MODEL
-from src.core.paths import normalize_path, safe_join_path
+from src.core.dataset_session import DatasetSession, get_query_name_type
+from src.api.request_engine import RequestEngine, NETWORK_ERROR
+from src.core.settings import DEFAULT_EXTRACTOR_MODEL, DEFAULT_MAX_IN_FLIGHT
+from src.core.paths import normalize_path
+from src.utils.jsonl_utils import resume_jsonl
 
 
 def query_filter(qid, gs=None, gp=None, gi=None, f_infer_history=[]):
@@ -381,7 +379,58 @@ def add_mistake_hint(query_type):
             return "Please carefully check before arriving at the final answer to confirm whether the reasoning aligns with the observed event states and the dependencies between events, as updated based on counterfactual assumptions."
 
 
-def test_llm(api_key, model, query_type, graph_shape_group, graph_shape, name_type, prompt_type, data_folder, output_path):
+def get_query_text(session, query_type, name_type, query_item_id):
+    """
+    Build the base query text (prompt without examples or hints) of one query.
+
+    The text is kept in the session, so every prompt type and the answer
+    extraction of the same query reuse it.
+
+    Args:
+        name_type: Node name type as returned by get_query_name_type
+    """
+    key = (query_type, name_type, query_item_id)
+    if key not in session.query_texts:
+        if query_type[0:4] == "conf":
+            c_relation, ce_query = session.render("conf", query_item_id, name_type)
+            ce_path_query, conf_ctrl_query = get_conf_prompt(c_relation, ce_query, name_type)
+            if query_type == "conf_ce_path":
+                query = ce_path_query
+            else:
+                query = conf_ctrl_query
+
+        else:
+            c_relation, clue, f_query, cf_query, what_if = session.render("cf", query_item_id, name_type)
+            f_infer_query, cf_infer_query = get_cf_prompt(c_relation, clue, f_query, cf_query, what_if, name_type)
+            if query_type == "cf_f_infer":
+                query = f_infer_query
+            else:
+                query = cf_infer_query
+        session.query_texts[key] = query
+    return session.query_texts[key]
+
+
+def get_input_text(query, query_type, prompt_type):
+    input_text = ""
+    match prompt_type:
+        case "zero_shot":
+            input_text = query + "\nYour answer should be plain text and should not contain other formats such as markdown.\nAnswer:\n"
+        case "one_shot":
+            input_text = add_1_example(query_type) + "\n\n" + query + "\nAnswer:\n"
+        case "two_shot":
+            input_text = add_2_examples(query_type) + "\n\n" + query + "\nAnswer:\n"
+        case "zero_cot":
+            input_text = query + "\nYour answer should be plain text and should not contain other formats such as markdown.\nAnswer:\n" + add_zero_shot_cot()
+        case "one_cot":
+            input_text = add_1_shot_cot(query_type) + "\n\n" + query + "\nAnswer:\n"
+        case "two_cot":
+            input_text = add_2_shot_cot(query_type) + "\n\n" + query + "\nAnswer:\n"
+        case "mis_hint":
+            input_text = query + "\n" + add_mistake_hint(query_type) + "\nYour answer should be plain text and should not contain other formats such as markdown.\nAnswer:\n"
+    return input_text
+
+
+def test_llm(api_key, model, query_type, graph_shape_group, graph_shape, name_type, prompt_type, data_folder, output_path, session=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT, cache=True, resume=False, hedge=None):
     # Use DEFAULT_EXTRACTOR_MODEL as fallback if model parameter is None
     if model is None:
         model = DEFAULT_EXTRACTOR_MODEL
@@ -389,120 +438,53 @@ def test_llm(api_key, model, query_type, graph_shape_group, graph_shape, name_ty
     # Normalize paths
     data_folder = normalize_path(data_folder)
     output_path = normalize_path(output_path)
-    
-    # Construct paths using safe_join_path
-    f_qd_path = safe_join_path(data_folder, f"{query_type.split('_')[0]}_query_data_{graph_shape_group}.pkl")
-    f_nd_path = safe_join_path(data_folder, f"node_name_data_{graph_shape_group}.pkl")
-    f_gd_path = safe_join_path(data_folder, f"graph_data_{graph_shape_group}.pkl")
-    
-    f_qd = open(f_qd_path, 'rb')
-    f_nd = open(f_nd_path, 'rb')
-    f_gd = open(f_gd_path, 'rb')
-    f_out = open(output_path, 'w', encoding='utf-8')
-
-    test_counter = 0
-    f_infer_history = []
-    current_gid = ""
-    graph_dict = {}
-    name_dict = {}
-    retry_threshold = 3
-    global_retry_threshold = retry_threshold * 20
-    global_retried_cnt = 0
-    if query_type[0:2] == "cf":
-        if name_type != "specific":
-            name_type = name_type + "_c"
-    while True:
-        try:
-            query_dict = pickle.load(f_qd)
-            if query_type[0:4] == "conf":
-                query_item_id = query_dict['conf_id']
-            else:
-                query_item_id = query_dict['cf_id']
-            test_counter += 1
-            required_gid = query_item_id[:8]
-            if current_gid != required_gid:
-                while True:
-                    try:
-                        graph_dict = pickle.load(f_gd)
-                        name_dict = pickle.load(f_nd)
-                        read_g_gid = graph_dict['gid']
-                        read_n_gid = name_dict['gid']
-                        if read_g_gid == read_n_gid and read_g_gid == required_gid:
-                            current_gid = read_g_gid
-                            break
-                    except EOFError:
-                        print("Data incompatible.", flush=True)
-                        sys.exit("Data incompatible.")
 
+    # The session holds the graph, name and query data, loaded once for every test of the group
+    if session is None:
+        session = DatasetSession(data_folder, graph_shape_group)
+    query_data = session.query_data(query_type.split('_')[0])
+    # When resuming, queries answered in an earlier run are kept and only the others are sent
+    done_ids = resume_jsonl(output_path, "response_text", NETWORK_ERROR) if resume else set()
+    f_out = open(output_path, 'a' if resume else 'w', encoding='utf-8')
+
+    name_type = get_query_name_type(query_type, name_type)
+
+    def jobs():
+        test_counter = 0
+        f_infer_history = []
+        for query_item_id in query_data:
+            test_counter += 1
             if query_filter(qid=query_item_id, gs=graph_shape, f_infer_history=f_infer_history):
                 print(datetime.now(), f"test process at {test_counter} | {query_item_id}", flush=True)
-                if query_type[0:4] == "conf":
-                    c_relation, ce_query = conf_d2t(name_dict[name_type], query_dict, graph_dict['mat'])
-                    ce_path_query, conf_ctrl_query = get_conf_prompt(c_relation, ce_query, name_type)
-                    if query_type == "conf_ce_path":
-                        query = ce_path_query
-                    else:
-                        query = conf_ctrl_query
-
-                else:
-                    c_relation, clue, f_query, cf_query, what_if = cf_d2t(name_dict[name_type], query_dict, graph_dict['mat'])
-                    f_infer_query, cf_infer_query = get_cf_prompt(c_relation, clue, f_query, cf_query, what_if, name_type)
+                current_gid = query_item_id[:8]
+                if query_item_id in done_ids:
                     if query_type == "cf_f_infer":
-                        query = f_infer_query
                         f_infer_history.append(current_gid)
-                    else:
-                        query = cf_infer_query
-
-                input_text = ""
-                match prompt_type:
-                    case "zero_shot":
-                        input_text = query + "\nYour answer should be plain text and should not contain other formats such as markdown.\nAnswer:\n"
-                    case "one_shot":
-                        input_text = add_1_example(query_type) + "\n\n" + query + "\nAnswer:\n"
-                    case "two_shot":
-                        input_text = add_2_examples(query_type) + "\n\n" + query + "\nAnswer:\n"
-                    case "zero_cot":
-                        input_text = query + "\nYour answer should be plain text and should not contain other formats such as markdown.\nAnswer:\n" + add_zero_shot_cot()
-                    case "one_cot":
-                        input_text = add_1_shot_cot(query_type) + "\n\n" + query + "\nAnswer:\n"
-                    case "two_cot":
-                        input_text = add_2_shot_cot(query_type) + "\n\n" + query + "\nAnswer:\n"
-                    case "mis_hint":
-                        input_text = query + "\n" + add_mistake_hint(query_type) + "\nYour answer should be plain text and should not contain other formats such as markdown.\nAnswer:\n"
-
-                retry_cnt = 0
-                backoff_time = 10
-                res_text = "[Network Error]"
-                while retry_cnt < retry_threshold:
-                    try: # fails here. Why?
-                        res_text = get_response(api_key, model, input_text)['choices'][0]['message']['content']
-                        global_retried_cnt = 0
-                        break
-                    except Exception as e:
-                        print(f"Error: {e}", flush=True)
-                        time.sleep(backoff_time)
-                        backoff_time *= 1.5
-                        retry_cnt += 1
-                        global_retried_cnt += 1
-
-                print(f"======={query_item_id}=======", flush=True)
-                print(f"query:\n {input_text}\n", flush=True)
-                print(f"response:\n {res_text}\n", flush=True)
-                response_item = {"query_id": query_item_id, "input_text": input_text, "query_text": query, "response_text": res_text}
-                f_out.write(json.dumps(response_item, ensure_ascii=False) + '\n')
-                f_out.flush()
-                
-                if global_retried_cnt >= global_retry_threshold:
-                    f_qd.close()
-                    f_gd.close()
-                    f_nd.close()
+                    continue
+                if not session.has_graph(current_gid):
+                    print("Data incompatible.", flush=True)
                     f_out.close()
-                    sys.exit("Failed to connect to llm api after many retries.")
-        
-        except EOFError:
-            print("Data incompatible.", flush=True)
-            f_qd.close()
-            f_gd.close()
-            f_nd.close()
-            f_out.close()
-            break
\ No newline at end of file
+                    sys.exit("Data incompatible.")
+
+                query = get_query_text(session, query_type, name_type, query_item_id)
+                if query_type == "cf_f_infer":
+                    f_infer_history.append(current_gid)
+
+                input_text = get_input_text(query, query_type, prompt_type)
+                yield input_text, (query_item_id, input_text, query)
+
+    def write_response(payload, res_text):
+        query_item_id, input_text, query = payload
+        print(f"======={query_item_id}=======", flush=True)
+        print(f"query:\n {input_text}\n", flush=True)
+        print(f"response:\n {res_text}\n", flush=True)
+        response_item = {"query_id": query_item_id, "input_text": input_text, "query_text": query, "response_text": res_text}
+        f_out.write(json.dumps(response_item, ensure_ascii=False) + '\n')
+        f_out.flush()
+
+    # Queries are sent concurrently, responses are written in query order
+    engine = RequestEngine(api_key, model, max_in_flight, cache=cache, hedge=hedge)
+    finished = engine.run(jobs(), write_response)
+    f_out.close()
+    if not finished:
+        sys.exit("Failed to connect to llm api after many retries.")
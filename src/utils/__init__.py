@@ -4,13 +4,23 @@ General utility functions for the RGCI framework
 from src.utils.public_utils import (
     int2two_char_str,
     draw_graph,
+    render_graphs,
     node_name_gen_specific,
-    node_name_gen
+    node_name_gen,
+    node_name_item,
+    get_node_names,
+    count_paths,
+    PathSet
 )
 
 __all__ = [
     'int2two_char_str',
     'draw_graph',
+    'render_graphs',
     'node_name_gen_specific',
-    'node_name_gen'
+    'node_name_gen',
+    'node_name_item',
+    'get_node_names',
+    'count_paths',
+    'PathSet'
 ] 
\ No newline at end of file
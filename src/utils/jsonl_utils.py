@@ -0,0 +1,62 @@
+"""
+Reading and resuming the JSONL result files of testing and answer extraction
+"""
+import os
+import json
+
+
+def read_jsonl(path):
+    """
+    Read the records of a JSONL file, skipping lines that do not parse.
+
+    A run killed while writing leaves a truncated last line; it is dropped
+    instead of failing the whole file.
+
+    Returns:
+        tuple: (records, number of skipped lines)
+    """
+    records, skipped = [], 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                skipped += 1
+    return records, skipped
+
+
+def resume_jsonl(path, done_field, error_text, id_field="query_id"):
+    """
+    Prepare a JSONL result file to be resumed.
+
+    Records whose done_field holds a result (not error_text) are kept, once per
+    id; failed, duplicate and truncated records are dropped. The file is
+    rewritten with the kept records, so the missing ones can be appended to it.
+
+    Args:
+        path (str): Result file, which may not exist yet
+        done_field (str): Field holding the result, e.g. "response_text"
+        error_text (str): Result of a failed request
+        id_field (str): Field holding the record id
+
+    Returns:
+        set: Ids of the kept records
+    """
+    if not os.path.isfile(path):
+        return set()
+    records, skipped = read_jsonl(path)
+    kept = {}
+    for record in records:
+        if record.get(done_field) not in (None, error_text) and record.get(id_field) not in kept:
+            kept[record[id_field]] = record
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for record in kept.values():
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    os.replace(tmp_path, path)
+
+    print(f"Resuming {path}: {len(kept)} done, {len(records) - len(kept)} failed or duplicate, {skipped} truncated", flush=True)
+    return set(kept)
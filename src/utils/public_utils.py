@@ -1,39 +1,268 @@
 import graphviz
-import random
 import string
 import numpy as np
 import sys
 import os
+import subprocess
+from array import array
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from src.core.paths import NAME_DATA_DIR
 
+LOWERCASE = np.array(list(string.ascii_lowercase), dtype=object)
+
 
 # Visualize graph by graphviz
-def draw_graph(matrix, node_name, file_name):
+def graph_digraph(matrix, node_name):
     g = graphviz.Digraph()
     row, col = matrix.shape
     for i in range(row):
         for j in range(row):
             if matrix[i][j] == 1:
                 g.edge(str(node_name[i]), str(node_name[j]))
+    return g
+
+
+def draw_graph(matrix, node_name, file_name):
+    g = graph_digraph(matrix, node_name)
     g.render(file_name, format='png', cleanup=True)
 
 
+def draw_graph_batch(render_items):
+    """
+    Render several graphs with a single `dot` invocation.
+
+    Produces the same files as calling draw_graph on every item: the source is
+    written to file_name, rendered to file_name.png and removed afterwards.
+
+    Args:
+        render_items (list): (matrix, node_name, file_name) tuples
+    """
+    file_names = []
+    for matrix, node_name, file_name in render_items:
+        graph_digraph(matrix, node_name).save(file_name)
+        file_names.append(file_name)
+    try:
+        subprocess.run(["dot", "-Tpng", "-O", *file_names], check=True, capture_output=True)
+    finally:
+        for file_name in file_names:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+
+def render_graphs(render_queue, batch_size=64, workers=None):
+    """
+    Drain a queue of deferred graph renders.
+
+    The queue is split into batches of `batch_size` graphs, one `dot` process per
+    batch, and the batches are rendered by a pool of `workers` threads.
+
+    Args:
+        render_queue (list): (matrix, node_name, file_name) tuples
+        batch_size (int): Number of graphs rendered per `dot` invocation
+        workers (int): Number of concurrent `dot` processes (default: CPU count)
+    """
+    batches = [render_queue[i:i+batch_size] for i in range(0, len(render_queue), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        # list() re-raises the first failed batch
+        list(executor.map(draw_graph_batch, batches))
+
+
 # DFS path search
-def find_all_paths(adj_matrix, start, end_node):
-    def dfs(current_node, end, path):
-        path.append(current_node)
-        if current_node == end:
-            all_paths.append(list(path))
+def reachable_to(adj_matrix, end_node):
+    # Mask of the nodes that can reach end_node (reverse BFS)
+    can_reach = np.zeros(adj_matrix.shape[0], dtype=bool)
+    can_reach[end_node] = True
+    frontier = [end_node]
+    while len(frontier):
+        pred = adj_matrix[:, frontier].any(axis=1) & ~can_reach
+        can_reach |= pred
+        frontier = np.flatnonzero(pred)
+    return can_reach
+
+
+def iter_all_paths(adj_matrix, start, end_node, can_reach=None):
+    """
+    Yield all simple paths from start to end_node, in depth-first order.
+
+    Only nodes that can still reach end_node are expanded: they are found first
+    with a reverse BFS, so dead-end branches are never explored. A precomputed
+    mask of those nodes (e.g. GraphReach.reach_mask) can be passed as can_reach.
+    """
+    adj_matrix = np.asarray(adj_matrix, dtype=bool)
+    node_n = adj_matrix.shape[0]
+    if can_reach is None:
+        can_reach = reachable_to(adj_matrix, end_node)
+
+    if start == end_node:
+        yield [start]
+        return
+    if not can_reach[start]:
+        return
+
+    neighbors = [np.flatnonzero(adj_matrix[i] & can_reach).tolist() for i in range(node_n)]
+    path = [start]
+    on_path = 1 << start  # bitmask of the nodes on the current path
+    stack = [iter(neighbors[start])]
+    while stack:
+        for neighbor in stack[-1]:
+            if not on_path >> neighbor & 1:
+                break
+        else:
+            stack.pop()
+            on_path ^= 1 << path.pop()
+            continue
+
+        if neighbor == end_node:
+            yield path + [neighbor]
         else:
-            for neighbor, is_connected in enumerate(adj_matrix[current_node]):
-                if is_connected and neighbor not in path:
-                    dfs(neighbor, end, path)
-        path.pop()
+            path.append(neighbor)
+            on_path |= 1 << neighbor
+            stack.append(iter(neighbors[neighbor]))
+
+
+def find_all_paths(adj_matrix, start, end_node, can_reach=None):
+    return list(iter_all_paths(adj_matrix, start, end_node, can_reach))
+
+
+def count_paths(adj_matrix, start, end_node, directed=True, limit=None, can_reach=None):
+    """
+    Count the simple paths from start to end_node without listing them.
+
+    Args:
+        adj_matrix: Adjacency matrix, a DAG if directed, else symmetric
+        directed (bool): Count with a dynamic program over a topological order.
+            Simple paths of an undirected graph have no such recurrence and are
+            counted by a depth-first walk instead.
+        limit (int): Stop counting undirected paths once more than `limit`
+            are found
+        can_reach: Optional precomputed mask of the nodes that can reach end_node
+
+    Returns:
+        int: Number of paths, or limit + 1 if an undirected count exceeded limit
+    """
+    adj_matrix = np.asarray(adj_matrix, dtype=bool)
+    if not directed:
+        path_n = 0
+        for _ in iter_all_paths(adj_matrix, start, end_node, can_reach):
+            path_n += 1
+            if limit is not None and path_n > limit:
+                break
+        return path_n
+
+    # Kahn's algorithm, accumulating the number of paths from start along the way
+    in_degree = np.sum(adj_matrix, axis=0, dtype=int)
+    successors = [np.flatnonzero(row).tolist() for row in adj_matrix]
+    path_n = [0] * adj_matrix.shape[0]
+    path_n[start] = 1
+    ready = np.flatnonzero(in_degree == 0).tolist()
+    while ready:
+        node = ready.pop()
+        for s in successors[node]:
+            path_n[s] += path_n[node]
+            in_degree[s] -= 1
+            if in_degree[s] == 0:
+                ready.append(s)
+    return path_n[end_node]
+
+
+class PathSet:
+    """
+    Ragged (CSR) storage for the paths of several cause/effect pairs.
+
+    All path nodes live in one flat int16 array. Path k is
+    nodes[path_offsets[k]:path_offsets[k+1]], and pair p owns paths
+    pair_offsets[p] to pair_offsets[p+1]. Indexing a PathSet gives a lazy view of
+    one pair's paths, and indexing that view gives a path as a list, so a PathSet
+    reads like the nested lists it replaces.
 
-    all_paths = []
-    dfs(start, end_node, [])
+    Paths are appended as they are enumerated (add_pair, add_path) and the
+    buffers are turned into numpy arrays by finish().
+    """
 
-    return all_paths
+    def __init__(self):
+        self._nodes = array('h')
+        self._path_offsets = array('i', [0])
+        self._pair_offsets = array('i', [0])
+        self.nodes = None
+        self.path_offsets = None
+        self.pair_offsets = None
+
+    @classmethod
+    def from_paths(cls, paths_per_pair):
+        """Build a PathSet from nested lists (one list of paths per pair)."""
+        path_set = cls()
+        for paths in paths_per_pair:
+            path_set.add_pair()
+            for path in paths:
+                path_set.add_path(path)
+        return path_set.finish()
+
+    def add_pair(self):
+        self._pair_offsets.append(self._pair_offsets[-1])
+
+    def add_path(self, path):
+        self._nodes.extend(path)
+        self._path_offsets.append(len(self._nodes))
+        self._pair_offsets[-1] += 1
+
+    def finish(self):
+        self.nodes = np.frombuffer(self._nodes, dtype=np.int16).copy()
+        self.path_offsets = np.frombuffer(self._path_offsets, dtype=np.int32).copy()
+        self.pair_offsets = np.frombuffer(self._pair_offsets, dtype=np.int32).copy()
+        del self._nodes, self._path_offsets, self._pair_offsets
+        return self
+
+    @property
+    def path_n(self):
+        return len(self.path_offsets) - 1
+
+    def path(self, k):
+        return self.nodes[self.path_offsets[k]:self.path_offsets[k+1]].tolist()
+
+    def path_keys(self):
+        # One hashable bytes key per path, taken straight from the flat array
+        return [self.nodes[self.path_offsets[k]:self.path_offsets[k+1]].tobytes() for k in range(self.path_n)]
+
+    def tolist(self):
+        return [list(pair) for pair in self]
+
+    def __len__(self):
+        return len(self.pair_offsets) - 1
+
+    def __getitem__(self, pair):
+        if pair < 0:
+            pair += len(self)
+        if not 0 <= pair < len(self):
+            raise IndexError("PathSet index out of range")
+        return PairPaths(self, pair)
+
+    def __iter__(self):
+        for pair in range(len(self)):
+            yield PairPaths(self, pair)
+
+
+class PairPaths:
+    """Lazy list view of the paths of one cause/effect pair in a PathSet."""
+
+    def __init__(self, path_set, pair):
+        self.path_set = path_set
+        self.start = int(path_set.pair_offsets[pair])
+        self.stop = int(path_set.pair_offsets[pair+1])
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, k):
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError("PairPaths index out of range")
+        return self.path_set.path(self.start + k)
+
+    def __iter__(self):
+        for k in range(self.start, self.stop):
+            yield self.path_set.path(k)
 
 
 def int2str(n):
@@ -55,15 +284,23 @@ def int2str_plain(n):
     return text
 
 
-def random_str_gen(n):
-    str_list = []
-    for i in range(n):
-        str_list.append(''.join(random.choices(string.ascii_lowercase, k=5)))
+def random_str_gen(n, rng=None):
+    # n random strings of 5 lowercase letters, drawn in one call
+    if rng is None:
+        letters = np.random.randint(0, 26, size=(n, 5))
+    else:
+        letters = rng.integers(0, 26, size=(n, 5))
+    return ["".join(chars) for chars in LOWERCASE[letters].tolist()]
 
-    return str_list
 
+@lru_cache(maxsize=None)
+def load_name_vocab(name_type):
+    """
+    Read name_data/<name_type>.txt once per process.
 
-def node_name_gen(specific_name, name_type):
+    Returns:
+        tuple: (noun, change) object arrays, change holding the two change words of each noun
+    """
     file_path = os.path.join(NAME_DATA_DIR, name_type + ".txt")
     with open(file_path, 'r', encoding='utf-8') as f:
         lines = f.readlines()
@@ -72,32 +309,77 @@ def node_name_gen(specific_name, name_type):
     for i in lines:
         words = i.split()
         noun.append(words[0])
-        change.append(words[1:])
+        change.append(words[1:3])
+
+    return np.array(noun, dtype=object), np.array(change, dtype=object)
+
+
+def node_name_draw(node_n, name_type, rng=None):
+    """
+    Draw the vocabulary index and change-word index of every node for one name type.
+
+    Returns:
+        numpy.ndarray: (2, node_n) uint16 array of noun indexes and change-word indexes
+    """
+    name_candidate_n = len(load_name_vocab(name_type)[0])
+    if rng is None:
+        n_idx = np.random.randint(0, name_candidate_n, size=node_n)
+        c_idx = np.random.randint(0, 2, size=node_n)
+    else:
+        n_idx = rng.integers(0, name_candidate_n, size=node_n)
+        c_idx = rng.integers(0, 2, size=node_n)
+    return np.stack([n_idx, c_idx]).astype(np.uint16)
+
+
+def node_name_decode(specific_name, name_type, name_idx):
+    # Rebuild the names of one name type from node_name_draw indexes
+    noun, change = load_name_vocab(name_type)
+    n_idx, c_idx = name_idx
+    name = np.array(specific_name, dtype=object) + " " + noun[n_idx]
+    name_c = change[n_idx, c_idx] + " of " + name
+    return name.tolist(), name_c.tolist()
+
 
-    name_candidate_n = len(noun)
+def node_name_gen(specific_name, name_type, rng=None):
+    name_idx = node_name_draw(len(specific_name), name_type, rng)
+    return node_name_decode(specific_name, name_type, name_idx)
 
-    node_name = []
-    node_name_c = []
 
-    for s_n in specific_name:
-        n_idx = np.random.randint(0, name_candidate_n)
-        c_idx = np.random.randint(0, 2)
-        name = s_n + " " + noun[n_idx]
-        name_c = change[n_idx][c_idx] + " of " + s_n + " " + noun[n_idx]
-        node_name.append(name)
-        node_name_c.append(name_c)
+def node_name_item(gid, specific_name, name_type, rng=None):
+    """
+    Build the dictionary-encoded node name record of one graph.
 
-    return node_name, node_name_c
+    Only the specific names are stored as text. The domain names are stored as
+    node_name_draw indexes into the name_data vocabularies, one (2, node_n) slice
+    per entry of name_type, and are rebuilt by get_node_names.
+    """
+    name_idx = np.stack([node_name_draw(len(specific_name), n_t, rng) for n_t in name_type])
+    return {
+        "gid": gid,
+        "specific": specific_name,
+        "name_type": list(name_type),
+        "name_idx": name_idx,
+    }
 
 
-def node_name_gen_specific(node_list):
-    node_name_s = []
+def get_node_names(name_item, name_type):
+    """
+    Get the node names of one name type ("specific", "bio", "bio_c", ...) from a name record.
 
-    for i in range(len(node_list)):
-        specific_name = random_str_gen(1)[0] + int2str_plain(node_list[i])
-        node_name_s.append(specific_name)
+    Encoded records are decoded on first access and the names are kept in the
+    record, so each graph is decoded once per name type. Records with the names
+    stored as text are read as they are.
+    """
+    if name_type not in name_item:
+        domain = name_type[:-2] if name_type.endswith("_c") else name_type
+        t = name_item["name_type"].index(domain)
+        name_item[domain], name_item[domain + "_c"] = node_name_decode(name_item["specific"], domain, name_item["name_idx"][t])
+    return name_item[name_type]
 
-    return node_name_s
+
+def node_name_gen_specific(node_list, rng=None):
+    prefix = random_str_gen(len(node_list), rng)
+    return [p + int2str_plain(n) for p, n in zip(prefix, node_list)]
 
 def int2two_char_str(n):
     if 0 <= n < 10:
@@ -110,6 +392,13 @@ def int2two_char_str(n):
         raise ValueError("Integer out of range.")
 
 
+def join_names(names):
+    # "a", "a and b", "a, b and c"
+    if len(names) > 1:
+        return ", ".join(names[:-1]) + " and " + names[-1]
+    return "".join(names)
+
+
 def get_size(obj, seen=None):
     """Recursively finds size of objects"""
     size = sys.getsizeof(obj)
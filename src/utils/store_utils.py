@@ -0,0 +1,304 @@
+"""
+Indexed access to the generated pickle data
+
+Every data file is a stream of pickled records. A sidecar "<file>.idx" maps the id
+of each record (gid, conf_id or cf_id) to its byte offset in the stream, so records
+can be read in any order without scanning the file. Data files written before the
+index existed are converted with:
+
+    python -m src.utils.store_utils [pickle_dir]
+
+Generation also writes the adjacency matrices of a group as one memory-mapped
+"adj_tensor_<group>.npy" tensor, with the gid and node count of every row in
+"adj_tensor_<group>.idx.npz".
+"""
+import os
+import sys
+import glob
+import pickle
+import argparse
+import numpy as np
+from numpy.lib.format import open_memmap
+
+INDEX_SUFFIX = ".idx"
+
+# Id field of the records in each data file, by file name prefix
+ID_FIELDS = {
+    "graph_data": "gid",
+    "node_name_data": "gid",
+    "conf_query_data": "conf_id",
+    "cf_query_data": "cf_id",
+}
+
+
+def get_id_field(path):
+    file_name = os.path.basename(path)
+    for prefix, id_field in ID_FIELDS.items():
+        if file_name.startswith(prefix + "_"):
+            return id_field
+    raise ValueError(f"Unknown data file: {path}")
+
+
+def write_index(path, id_field, offsets):
+    # The data file size and mtime are stored to detect an index left from older data
+    stat = os.stat(path)
+    index = {"id_field": id_field, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "offsets": offsets}
+    tmp_path = path + INDEX_SUFFIX + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(index, f)
+    os.replace(tmp_path, path + INDEX_SUFFIX)
+
+
+def build_index(path, id_field=None):
+    """
+    Scan a pickle stream once and write its sidecar index.
+
+    Returns:
+        dict: record id -> byte offset, in file order
+    """
+    if id_field is None:
+        id_field = get_id_field(path)
+    offsets = {}
+    with open(path, "rb") as f:
+        while True:
+            offset = f.tell()
+            try:
+                item = pickle.load(f)
+            except EOFError:
+                break
+            offsets[item[id_field]] = offset
+    write_index(path, id_field, offsets)
+    return offsets
+
+
+def load_index(path, id_field=None):
+    # Offsets from the sidecar index, rebuilt if it is missing or out of date
+    try:
+        with open(path + INDEX_SUFFIX, "rb") as f:
+            index = pickle.load(f)
+        stat = os.stat(path)
+        if (index["size"], index["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns) and id_field in (None, index["id_field"]):
+            return index["offsets"]
+    except (OSError, EOFError, pickle.UnpicklingError, KeyError):
+        pass
+    return build_index(path, id_field)
+
+
+class IndexedPickleWriter:
+    """
+    Write records to a pickle stream and its sidecar index.
+
+    The stream is a plain concatenation of pickles, so it can still be read with
+    repeated pickle.load calls.
+    """
+
+    def __init__(self, path, id_field=None):
+        self.path = path
+        self.id_field = id_field if id_field is not None else get_id_field(path)
+        self.offsets = {}
+        self.f = open(path, "wb")
+
+    def dump(self, item):
+        self.offsets[item[self.id_field]] = self.f.tell()
+        pickle.dump(item, self.f)
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+            write_index(self.path, self.id_field, self.offsets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class IndexedPickleStore:
+    """
+    Random access to the records of a pickle stream by id.
+
+    Records are only unpickled when they are read, so ids can be filtered
+    before any record is loaded.
+    """
+
+    def __init__(self, path, id_field=None):
+        self.path = path
+        self.offsets = load_index(path, id_field)
+        self.f = open(path, "rb")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, record_id):
+        return record_id in self.offsets
+
+    def __getitem__(self, record_id):
+        self.f.seek(self.offsets[record_id])
+        return pickle.load(self.f)
+
+    def __iter__(self):
+        # Records in file order
+        for record_id in self.offsets:
+            yield self[record_id]
+
+    def keys(self):
+        # Record ids in file order
+        return list(self.offsets)
+
+    def get(self, record_id, default=None):
+        if record_id not in self.offsets:
+            return default
+        return self[record_id]
+
+    def subset(self, record_ids):
+        # Records of the given ids in the given order, skipping unknown ids
+        for record_id in record_ids:
+            if record_id in self.offsets:
+                yield self[record_id]
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def adj_tensor_paths(graph_data_path):
+    # adj_tensor_<group>.npy and its row index, next to graph_data_<group>.pkl
+    folder, file_name = os.path.split(graph_data_path)
+    stem = "adj_tensor_" + file_name[len("graph_data_"):-len(".pkl")]
+    return os.path.join(folder, stem + ".npy"), os.path.join(folder, stem + ".idx.npz")
+
+
+class AdjTensorWriter:
+    """
+    Write the adjacency matrices of a group into a (graph_n, max_node_n, max_node_n)
+    bool tensor on disk, zero-padded past each graph's node count.
+    """
+
+    def __init__(self, graph_data_path, graph_n, max_node_n):
+        self.graph_data_path = graph_data_path
+        self.path, self.index_path = adj_tensor_paths(graph_data_path)
+        self.mat = open_memmap(self.path, mode="w+", dtype=np.bool_, shape=(graph_n, max_node_n, max_node_n))
+        self.gids = []
+        self.node_n = []
+
+    def add(self, gid, matrix):
+        n = matrix.shape[0]
+        self.mat[len(self.gids), :n, :n] = matrix
+        self.gids.append(gid)
+        self.node_n.append(n)
+
+    def close(self):
+        if self.mat is not None:
+            self.mat.flush()
+            self.mat = None
+            # The graph pickle's size and mtime are stored to detect a tensor left from older data,
+            # so the writer has to be closed after the graph pickle
+            stat = os.stat(self.graph_data_path)
+            np.savez(self.index_path, gid=np.array(self.gids), node_n=np.array(self.node_n, dtype=np.int32),
+                     data_size=stat.st_size, data_mtime_ns=stat.st_mtime_ns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AdjTensor:
+    """
+    Read-only view of an adjacency tensor written by AdjTensorWriter.
+
+    The tensor is opened with mmap_mode='r', so processes opening the same file
+    share its pages and a graph is only read from disk when it is indexed.
+    """
+
+    def __init__(self, graph_data_path):
+        path, index_path = adj_tensor_paths(graph_data_path)
+        self.mat = np.load(path, mmap_mode="r")
+        with np.load(index_path) as index:
+            self.gids = index["gid"].tolist()
+            self.node_n = index["node_n"]
+        self.rows = {gid: row for row, gid in enumerate(self.gids)}
+
+    def __len__(self):
+        return len(self.gids)
+
+    def __contains__(self, gid):
+        return gid in self.rows
+
+    def __getitem__(self, gid):
+        row = self.rows[gid]
+        n = self.node_n[row]
+        return self.mat[row, :n, :n]
+
+    def close(self):
+        self.mat = None
+
+
+class GraphAdjStore:
+    """
+    Adjacency matrices by gid read from the graph pickle, for groups generated
+    without an adjacency tensor.
+    """
+
+    def __init__(self, graph_data_path):
+        self.graph_store = IndexedPickleStore(graph_data_path)
+
+    def __len__(self):
+        return len(self.graph_store)
+
+    def __contains__(self, gid):
+        return gid in self.graph_store
+
+    def __getitem__(self, gid):
+        from src.core.graph_utils import get_adj_mat
+        return get_adj_mat(self.graph_store[gid])
+
+    def close(self):
+        self.graph_store.close()
+
+
+def open_adj_store(graph_data_path):
+    """
+    Open the adjacency matrices of a group by gid, from its adjacency tensor
+    when it exists and from the graph pickle otherwise.
+    """
+    path, index_path = adj_tensor_paths(graph_data_path)
+    # A tensor written for another version of the graph pickle was left from an earlier generation
+    try:
+        with np.load(index_path) as index:
+            fingerprint = (int(index["data_size"]), int(index["data_mtime_ns"]))
+        stat = os.stat(graph_data_path)
+        if os.path.exists(path) and fingerprint == (stat.st_size, stat.st_mtime_ns):
+            return AdjTensor(graph_data_path)
+    except (OSError, KeyError, ValueError):
+        pass
+    return GraphAdjStore(graph_data_path)
+
+
+def main():
+    from src.core.settings import PICKLE_DIR
+
+    parser = argparse.ArgumentParser(description="Build the sidecar offset indexes of generated pickle data")
+    parser.add_argument('data_folder', nargs='?', default=PICKLE_DIR,
+                        help='Folder holding the generated pickle files')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.data_folder, "*.pkl")))
+    for path in paths:
+        try:
+            id_field = get_id_field(path)
+        except ValueError:
+            continue
+        offsets = build_index(path, id_field)
+        print(f"{path}: {len(offsets)} records indexed by {id_field}", flush=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())